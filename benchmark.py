@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess  # nosec
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import BaseRequestHandler, TCPServer, ThreadingMixIn
+from urllib.parse import parse_qs, quote, urlparse
+
+from lib.filters import Resolution, ReleaseType, SceneTags, VideoCodec, AudioCodec
+from lib.formatter import ExtendedFormatter, sizeof_fmt
+from lib.limits import Concurrency
+from lib.parsers import HTMLParser, JSONParser, RegexParser, XMLParser, XMLStreamParser
+from lib.scraper import Scraper, ScraperRunner, default_session, warm_up
+from lib.utils import Magnet
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
+
+# Modules imported by the plugin entry point (main.py). The ones provided by Kodi are stubbed (see _STARTUP_STUBS)
+STARTUP_MODULES = ("lib.provider",)
+# Modules which must only be imported once a search actually needs them
+DEFERRED_MODULES = ("requests", "htmlement", "defusedxml", "concurrent.futures", "pyexpat", "sqlite3", "socketserver",
+                    "email.utils")
+
+# Kodi and flix modules are not available outside Kodi, so they are replaced by stand-ins, which are not timed
+_STARTUP_STUBS = """\
+import types
+class Stub(object):
+    def __init__(self, *args, **kwargs):
+        pass
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: ""
+for name, attributes in (
+        ("xbmc", dict(Monitor=Stub, translatePath=str)),
+        ("xbmcaddon", dict(Addon=Stub)),
+        ("xbmcgui", dict(DialogProgressBG=Stub)),
+        ("xbmcvfs", dict(translatePath=str)),
+        ("flix", dict(__path__=[])),
+        ("flix.kodi", dict(ADDON_PATH={root!r}, ADDON_NAME="Magneto", get_boolean_setting=bool, get_int_setting=int,
+                           translate=str, set_logger=Stub)),
+        ("flix.provider", dict(Provider=Stub, ProviderResult=Stub))):
+    sys.modules[name] = types.ModuleType(name)
+    vars(sys.modules[name]).update(attributes)
+"""
+
+_STARTUP_SCRIPT = """\
+import json, sys, time
+{stubs}
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(elapsed=elapsed, loaded=[m for m in {deferred!r} if m in sys.modules])))
+"""
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def measure_startup(runs=10):
+    stubs = _STARTUP_STUBS.format(root=ROOT_PATH)
+    script = _STARTUP_SCRIPT.format(stubs=stubs, modules=STARTUP_MODULES, deferred=DEFERRED_MODULES)
+    timings, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=ROOT_PATH)  # nosec
+        data = json.loads(output)
+        timings.append(data["elapsed"] * 1000)
+        loaded.update(data["loaded"])
+    return timings, sorted(loaded)
+
+
+def startup(args):
+    timings, loaded = measure_startup(runs=args.runs)
+    median = statistics.median(timings)
+    logging.info("Startup import time: median=%.2fms min=%.2fms max=%.2fms (%d runs)",
+                 median, min(timings), max(timings), len(timings))
+
+    if loaded:
+        raise BenchmarkError("Modules imported at startup which should be deferred: {}".format(", ".join(loaded)))
+    if median > args.budget:
+        raise BenchmarkError("Startup import time ({:.2f}ms) exceeds the budget ({:.2f}ms)".format(
+            median, args.budget))
+
+
+_RESOLUTIONS = ("480p", "720p", "1080p", "2160p", "")
+_SOURCES = ("WEB-DL", "WEBRip", "BluRay", "HDTV", "DVDRip", "HDRip", "CAM", "")
+_VIDEO_CODECS = ("x264", "x265", "HEVC", "XviD", "")
+_AUDIO_CODECS = ("AAC", "AC3", "DD5.1", "DTS", "DTS-HD.MA", "MP3", "")
+_GROUPS = ("RARBG", "YTS", "EVO", "NTb", "FGT", "PROPER", "ION10")
+
+
+def generate_title(rng, query, index):
+    tokens = [query.replace(" ", ".")]
+    if rng.random() < 0.5:
+        tokens.append("S{:02}E{:02}".format(rng.randint(1, 10), rng.randint(1, 24)))
+    else:
+        tokens.append(str(rng.randint(1950, 2024)))
+    tokens.extend(rng.choice(values) for values in (_RESOLUTIONS, _SOURCES, _VIDEO_CODECS, _AUDIO_CODECS))
+    return "{}-{}{}".format(".".join(t for t in tokens if t), rng.choice(_GROUPS), index)
+
+
+def info_hash(*args):
+    return hashlib.sha1("/".join(str(a) for a in args).encode("utf-8")).hexdigest()  # nosec
+
+
+def _stand_in_search_page(rng, config, query, page):
+    rows = []
+    for i in range(config["rows"]):
+        # Hashes are shared across providers, so results are merged as they would on real searches
+        row_hash = info_hash(query, page, i)
+        rows.append('<tr><td><a href="/torrent/{}">{}</a></td><td>{}</td><td>{}</td><td>{} MB</td></tr>'.format(
+            row_hash, generate_title(rng, query, i), rng.randint(0, 5000), rng.randint(0, 500),
+            rng.randint(100, 10000)))
+    next_page = '<a class="next" href="/search?q={}&page={}">Next</a>'.format(
+        quote(query), page + 1) if page < config["pages"] else ""
+    padding = "<!-- {} -->".format("x" * config["page_size"]) if config["page_size"] else ""
+    return ('<html><head><meta charset="utf-8"></head><body>'
+            '<table><tbody>{}</tbody></table>{}{}</body></html>').format("".join(rows), next_page, padding)
+
+
+def _count_request(config):
+    with config["requests"].get_lock():
+        config["requests"].value += 1
+
+
+def stand_in_response(config, path):
+    # Returns the (status, body) of the stand-in provider page at path. Requests above the server capacity are throttled
+    slots = config.get("slots")
+    if slots is not None and not slots.acquire(False):
+        return 429, b""
+    try:
+        return _stand_in_page(config, path)
+    finally:
+        if slots is not None:
+            slots.release()
+
+
+def _stand_in_page(config, path):
+    url = urlparse(path)
+    params = parse_qs(url.query)
+    rng = random.Random(url.path + url.query)
+
+    time.sleep(max(0, config["latency"] + rng.uniform(-config["jitter"], config["jitter"])) / 1000.0)
+    if random.random() < config["error_rate"]:
+        return 503, b""
+
+    if url.path == "/search":
+        body = _stand_in_search_page(rng, config, params["q"][0], int(params.get("page", ["1"])[0]))
+    elif url.path.startswith("/torrent/"):
+        body = ('<html><head><meta charset="utf-8"></head><body>'
+                '<a class="magnet" href="magnet:?xt=urn:btih:{}&amp;dn=torrent">Magnet</a>'
+                '</body></html>').format(url.path.rsplit("/", 1)[-1])
+    else:
+        return 404, b""
+    return 200, body.encode("utf-8")
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, as most providers support them
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        _count_request(self.server.config)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        _count_request(self.server.config)
+        status, data = stand_in_response(self.server.config, self.path)
+        if status != 200:
+            self.send_error(status)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _H2StandInHandler(BaseRequestHandler):
+    # HTTP/2 over cleartext (prior knowledge). Each stream is answered on its own thread, so they are multiplexed
+    def handle(self):
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+        from h2.events import ConnectionTerminated, RequestReceived
+        from h2.exceptions import ProtocolError
+
+        self._conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+        self._condition = threading.Condition()
+        with self._condition:
+            self._conn.initiate_connection()
+            self.request.sendall(self._conn.data_to_send())
+
+        while True:
+            data = self.request.recv(65535)
+            if not data:
+                break
+            with self._condition:
+                try:
+                    events = self._conn.receive_data(data)
+                except ProtocolError:
+                    # h2 queues a GOAWAY frame, after which the client opens a new connection
+                    events = [ConnectionTerminated()]
+                self.request.sendall(self._conn.data_to_send())
+                # Flow control windows may have been updated
+                self._condition.notify_all()
+            for event in events:
+                if isinstance(event, RequestReceived):
+                    thread = threading.Thread(target=self._respond, args=(event.stream_id, dict(event.headers)))
+                    thread.daemon = True
+                    thread.start()
+                elif isinstance(event, ConnectionTerminated):
+                    return
+
+    def _respond(self, stream_id, headers):
+        from h2.exceptions import ProtocolError, StreamClosedError
+
+        try:
+            self._send_response(stream_id, headers)
+        except (ProtocolError, StreamClosedError, OSError):
+            # The stream or the connection were closed by the client
+            pass
+
+    def _send_response(self, stream_id, headers):
+        _count_request(self.server.config)
+        if headers[":method"] == "HEAD":
+            status, data = 200, b""
+        else:
+            status, data = stand_in_response(self.server.config, headers[":path"])
+
+        with self._condition:
+            self._conn.send_headers(stream_id, [(":status", str(status)), ("content-length", str(len(data))),
+                                                ("content-type", "text/html; charset=utf-8")], end_stream=not data)
+            while data:
+                size = min(self._conn.local_flow_control_window(stream_id), self._conn.max_outbound_frame_size)
+                if size <= 0:
+                    self._condition.wait()
+                    continue
+                self._conn.send_data(stream_id, data[:size], end_stream=size >= len(data))
+                data = data[size:]
+                self.request.sendall(self._conn.data_to_send())
+            self.request.sendall(self._conn.data_to_send())
+
+
+class _H2StandInServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _run_stand_in_server(config, queue):
+    if config["capacity"]:
+        config["slots"] = threading.BoundedSemaphore(config["capacity"])
+    if config["http2"]:
+        server = _H2StandInServer(("127.0.0.1", config["port"]), _H2StandInHandler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", config["port"]), _StandInHandler)
+        server.daemon_threads = True
+    server.config = config
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def stand_in_providers(base_url, count=1, pages=1, detail_pages=True, limits=None):
+    providers = []
+    for i in range(count):
+        data = {"torrent_url": "td[1]/a/@href", "title": "td[1]/a/text()", "seeds": "td[2]/text()",
+                "leeches": "td[3]/text()", "size": "td[4]/text()"}
+        provider = {
+            "name": "Stand-in {}".format(i + 1),
+            "base_url": base_url,
+            "results_parser": {
+                "url": "/search?q={query:q}",
+                "rows": ".//tbody/tr",
+                "data": data,
+                "total_pages": pages,
+                "next_page_url": ".//a[@class='next']/@href",
+            },
+            "keywords": {"movie": "{title} {year}", "show": "{title}", "season": "{title} S{season:02}",
+                         "episode": "{title} S{season:02}E{episode:02}"},
+        }
+        if detail_pages:
+            provider["additional_parsers"] = [
+                {"url": "{torrent_url}", "data": {"magnet": ".//a[@class='magnet']/@href"}}]
+        else:
+            provider["results_parser"]["mutate"] = {
+                "magnet": "magnet:?xt=urn:btih:{torrent_url:split('/').get(2)}"}
+        if limits:
+            provider["limits"] = limits
+        providers.append(provider)
+    return providers
+
+
+def _import_provider():
+    # lib.provider merges the results, but it requires Kodi, so it is imported with the startup stand-ins
+    if "lib.provider" not in sys.modules:
+        exec(_STARTUP_STUBS.format(root=ROOT_PATH), dict(sys=sys))  # nosec
+    import lib.provider
+    return lib.provider
+
+
+def merge_results(runner_data):
+    # Merges and sorts (scraper, result) pairs as the addon does, without filtering any result
+    provider = _import_provider()
+    return provider.sort_results(provider.merge_results(runner_data), lambda setting: False)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def _peak_memory():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def load(args):
+    if args.http2:
+        try:
+            import h2  # noqa: F401
+            from lib.http2 import Http2Session
+        except ImportError as e:
+            raise BenchmarkError("--http2 requires the httpx and h2 packages: {}".format(e))
+    # Imported before the searches start, so they don't import it at once
+    _import_provider()
+
+    config = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, rows=args.rows,
+                  pages=args.pages, page_size=args.page_size, port=args.port, http2=args.http2,
+                  capacity=args.capacity, requests=multiprocessing.Value("l", 0))
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_run_stand_in_server, args=(config, queue))
+    server.daemon = True
+    server.start()
+
+    try:
+        base_url = "http://127.0.0.1:{}".format(queue.get(timeout=10))
+        limits = {k: v for k, v in (("max_connections", args.max_connections), ("rate", args.rate)) if v is not None}
+        providers = stand_in_providers(base_url, count=args.providers, pages=args.pages,
+                                       detail_pages=not args.no_detail_pages, limits=limits)
+        if args.save_providers:
+            with open(args.save_providers, "w") as f:
+                json.dump(providers, f, indent=2)
+
+        latencies = []
+        counts = []
+        lock = threading.Lock()
+        # Shared by all searches, as done by the search service
+        concurrency = Concurrency(args.thread_number) if args.adaptive else None
+
+        def search(index):
+            if args.http2:
+                # The stand-in server only supports HTTP/2 with prior knowledge, as it does not support TLS (nor ALPN)
+                session = Http2Session(pool_size=args.thread_number, prior_knowledge=True)
+            else:
+                session = default_session(pool_size=args.thread_number)
+            with session:
+                scrapers = [Scraper.from_data(p, timeout=args.timeout, session=session, concurrency=concurrency)
+                            for p in providers]
+                start = time.perf_counter()
+                # Same as lib.provider.perform_search
+                warm_up(scrapers)
+                with ScraperRunner(scrapers, num_threads=args.thread_number) as runner:
+                    results = merge_results(runner.iter_parse_query("search {}".format(index % args.unique_queries)))
+                elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                counts.append(len(results))
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(search, range(args.searches)))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        server.terminate()
+        server.join()
+
+    peak_memory = _peak_memory()
+    logging.info("Searches: %d (concurrency %d) | Providers: %d | Results per search: %.1f",
+                 len(latencies), args.concurrency, args.providers, statistics.mean(counts))
+    logging.info("Latency: p50=%.1fms p99=%.1fms max=%.1fms", _percentile(latencies, 50) * 1000,
+                 _percentile(latencies, 99) * 1000, max(latencies) * 1000)
+    # All the requests received by the stand-in server (including warm ups, retries and hedged requests)
+    requests = config["requests"].value
+    logging.info("Throughput: %.2f searches/s | %.1f requests/s (%.1f per search) | Wall time: %.2fs",
+                 len(latencies) / wall, requests / wall, requests / float(len(latencies)), wall)
+    logging.info("CPU: %.2fs (%.0f%% of wall time) | Peak memory: %s", cpu, cpu / wall * 100,
+                 "n/a" if peak_memory is None else sizeof_fmt(peak_memory, divisor=1024.0))
+
+    if concurrency is not None:
+        adapted = concurrency.limits
+        logging.info("Adapted concurrency: total=%.1f | %s", adapted["total"],
+                     " | ".join("{}={:.1f}".format(host, limit) for host, limit in sorted(adapted["hosts"].items())))
+
+    if args.max_p99 is not None and _percentile(latencies, 99) * 1000 > args.max_p99:
+        raise BenchmarkError("p99 latency exceeds the budget ({:.2f}ms)".format(args.max_p99))
+
+
+def _micro_fixtures(rng, rows):
+    items = [dict(title=generate_title(rng, "Big Buck Bunny", i), hash=info_hash("micro", i),
+                  seeds=rng.randint(0, 5000), leeches=rng.randint(0, 500), size=rng.randint(10 ** 8, 10 ** 10))
+             for i in range(rows)]
+
+    html = "<html><head><meta charset=\"utf-8\"></head><body><table><tbody>{}</tbody></table></body></html>".format(
+        "".join('<tr><td><a href="/torrent/{hash}">{title}</a></td><td>{seeds}</td><td>{leeches}</td>'
+                '<td>{size}</td></tr>'.format(**item) for item in items))
+    rss = '<?xml version="1.0" encoding="utf-8"?><rss><channel>{}</channel></rss>'.format(
+        "".join("<item><title>{title}</title><link>magnet:?xt=urn:btih:{hash}</link><seeds>{seeds}</seeds>"
+                "<leeches>{leeches}</leeches><size>{size}</size></item>".format(**item) for item in items))
+    api = json.dumps({"data": {"torrents": items}})
+    magnets = ["magnet:?xt=urn:btih:{}&dn={}&tr=udp%3A%2F%2Ftracker.example.com%3A1337".format(
+        item["hash"], quote(item["title"])) for item in items]
+    return items, html.encode("utf-8"), rss.encode("utf-8"), api.encode("utf-8"), magnets
+
+
+class _MicroScraper(object):
+    def __init__(self, name):
+        self.name = self.id = name
+
+    # noinspection PyMethodMayBeStatic
+    def get_attribute(self, name, default=None):
+        return default
+
+
+def micro_benchmarks(rows=500):
+    items, html, rss, api, magnets = _micro_fixtures(random.Random(0), rows)
+    formatter = ExtendedFormatter()
+    html_data = {"url": "td[1]/a/@href", "title": "td[1]/a/text()", "seeds": "td[2]/text()",
+                 "leeches": "td[3]/text()", "size": "td[4]/text()"}
+    rss_data = {"title": "./title/text()", "magnet": "./link/text()", "seeds": "./seeds/text()",
+                "leeches": "./leeches/text()", "size": "./size/text()"}
+    api_data = dict(rss_data, magnet="./hash/text()")
+    regex_data = {"url": r'<a href="([^"]+)"', "title": r"<a [^>]*>([^<]*)</a>", "seeds": r"</a></td><td>(\d+)",
+                  "leeches": r"</a></td><td>\d+</td><td>(\d+)", "size": r"<td>([^<]*)</td></tr>"}
+    filters = (Resolution, ReleaseType, SceneTags, VideoCodec, AudioCodec)
+    scrapers = [_MicroScraper("Provider {}".format(i)) for i in range(3)]
+    rss_chunks = [rss[i:i + 16 * 1024] for i in range(0, len(rss), 16 * 1024)]
+    results = [dict(item, magnet=magnet) for item, magnet in zip(items, magnets)]
+
+    return [
+        ("html.parse_results", lambda: HTMLParser(html).parse_results(".//tbody/tr", html_data)),
+        ("json.parse_results", lambda: JSONParser(api).parse_results("./data/torrents/item", api_data)),
+        ("xml.parse_results", lambda: XMLParser(rss).parse_results("./channel/item", rss_data)),
+        # The rows are only counted, so the peak memory is the parser's own
+        ("xml.stream_results", lambda: sum(1 for _ in XMLStreamParser(rss_chunks).iter_results(
+            "./channel/item", rss_data))),
+        ("regex.parse_results", lambda: RegexParser(html).parse_results(r"<tr>.*?</tr>", regex_data)),
+        ("formatter.format", lambda: [
+            formatter.format("magnet:?xt=urn:btih:{hash}&dn={title:q}|{size!b}|{title:split('.').get(0)}", **item)
+            for item in items]),
+        ("filters.match", lambda: [f.match(item["title"]) for item in items for f in filters]),
+        ("magnet.from_string", lambda: [Magnet.from_string(magnet) for magnet in magnets]),
+        ("results.merge", lambda: merge_results((scraper, result) for scraper in scrapers for result in results)),
+    ]
+
+
+def _calibration():
+    # A fixed pure Python workload, so throughputs measured on different machines can be compared
+    words = ["{:x}".format(i * 2654435761 % 2 ** 32) for i in range(2000)]
+    counts = {}
+    for word in sorted(words):
+        counts[word[:2]] = counts.get(word[:2], 0) + len(word.upper())
+    return counts
+
+
+def measure_micro(func, min_time=1.0, repeat=3):
+    # Returns the best throughput (ops/s), the peak memory allocated by a single operation and the number of memory
+    # blocks allocated by it which are still held by its result
+    best = 0
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time:
+            func()
+            count += 1
+            elapsed = time.perf_counter() - start
+        best = max(best, count / elapsed)
+
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    finally:
+        tracemalloc.stop()
+    del result
+    return best, peak, sum(stat.count for stat in snapshot.statistics("filename"))
+
+
+def micro(args):
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    calibration, _, _ = measure_micro(_calibration, min_time=args.min_time, repeat=args.repeat)
+    logging.debug("Calibration: %.2f ops/s", calibration)
+    measures = {}
+    regressions = []
+    logging.info("%-20s %12s %12s %10s %10s", "Benchmark", "ops/s", "peak/op", "blocks/op", "change")
+    for name, func in micro_benchmarks(rows=args.rows):
+        if args.filter and args.filter not in name:
+            continue
+        ops, peak, blocks = measure_micro(func, min_time=args.min_time, repeat=args.repeat)
+        measures[name] = dict(ops=ops, peak=peak, blocks=blocks)
+
+        change = ""
+        if baseline and name in baseline["benchmarks"]:
+            # Throughputs are relative to the calibration workload, which makes baselines portable across machines
+            ratio = (ops / calibration) / (baseline["benchmarks"][name]["ops"] / baseline["calibration"]) - 1
+            change = "{:+.1%}".format(ratio)
+            if ratio < -args.threshold:
+                regressions.append(name)
+        logging.info("%-20s %12.2f %12s %10d %10s", name, ops, sizeof_fmt(peak, divisor=1024.0), blocks, change)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(dict(calibration=calibration, benchmarks=measures), f, indent=2, sort_keys=True)
+        logging.info("Baseline saved to %s", args.save_baseline)
+
+    if regressions:
+        raise BenchmarkError("Throughput regressed more than {:.0%} on: {}".format(
+            args.threshold, ", ".join(regressions)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tool to benchmark script.flix.magneto")
+    subparsers = parser.add_subparsers(title="command", dest="command", required=True, help="Command to execute")
+
+    parser_startup = subparsers.add_parser("startup", help="Measures the plugin entry point import time")
+    parser_startup.add_argument("-r", "--runs", type=int, default=10, help="The number of runs (default: 10)")
+    parser_startup.add_argument("-b", "--budget", type=float, default=50,
+                                help="The maximum median import time, in milliseconds (default: 50)")
+    parser_startup.set_defaults(func=startup)
+
+    parser_load = subparsers.add_parser("load", help="Runs concurrent searches against a local stand-in server")
+    parser_load.add_argument("-n", "--searches", type=int, default=50, help="The number of searches (default: 50)")
+    parser_load.add_argument("-c", "--concurrency", type=int, default=4,
+                             help="The number of concurrent searches (default: 4)")
+    parser_load.add_argument("-u", "--unique-queries", type=int, default=10,
+                             help="The number of distinct queries (default: 10)")
+    parser_load.add_argument("-P", "--providers", type=int, default=3, help="The number of providers (default: 3)")
+    parser_load.add_argument("-t", "--thread-number", type=int, default=10,
+                             help="The number of threads per search (default: 10)")
+    parser_load.add_argument("--timeout", type=int, default=30, help="The scraper timeout in seconds (default: 30)")
+    parser_load.add_argument("--latency", type=float, default=20, help="The server latency in ms (default: 20)")
+    parser_load.add_argument("--jitter", type=float, default=10, help="The server latency jitter in ms (default: 10)")
+    parser_load.add_argument("--error-rate", type=float, default=0,
+                             help="The fraction of requests failing with 503 (default: 0)")
+    parser_load.add_argument("--rows", type=int, default=25, help="The number of rows per page (default: 25)")
+    parser_load.add_argument("--pages", type=int, default=2, help="The number of result pages (default: 2)")
+    parser_load.add_argument("--page-size", type=int, default=0, help="Extra bytes of padding per page (default: 0)")
+    parser_load.add_argument("--no-detail-pages", action="store_true",
+                             help="Get magnets from the results pages instead of the detail pages")
+    parser_load.add_argument("--max-connections", type=int,
+                             help="The providers max_connections limit (default: no limit)")
+    parser_load.add_argument("--rate", type=float, help="The providers rate limit in requests/s (default: no limit)")
+    parser_load.add_argument("--capacity", type=int, default=0,
+                             help="The concurrent requests the server handles before throttling with 429 (default: "
+                                  "no limit)")
+    parser_load.add_argument("--adaptive", action="store_true",
+                             help="Adapts the requests concurrency, up to the number of threads per search")
+    parser_load.add_argument("--http2", action="store_true",
+                             help="Serves and requests the stand-in providers using HTTP/2 (requires httpx and h2)")
+    parser_load.add_argument("--port", type=int, default=0, help="The stand-in server port (default: random)")
+    parser_load.add_argument("--save-providers", type=str, help="Saves the stand-in providers.json to this path")
+    parser_load.add_argument("--max-p99", type=float, help="Fails if p99 latency (in ms) exceeds this value")
+    parser_load.set_defaults(func=load)
+
+    parser_micro = subparsers.add_parser("micro", help="Runs the hot paths microbenchmarks")
+    parser_micro.add_argument("-f", "--filter", type=str, help="Only runs the benchmarks containing this string")
+    parser_micro.add_argument("--rows", type=int, default=500,
+                              help="The number of rows/titles per fixture (default: 500)")
+    parser_micro.add_argument("--min-time", type=float, default=1.0,
+                              help="The minimum time, in seconds, of each run (default: 1)")
+    parser_micro.add_argument("--repeat", type=int, default=3, help="The number of runs, the best is kept (default: 3)")
+    parser_micro.add_argument("-b", "--baseline", type=str, help="Compares the results with this baseline file")
+    parser_micro.add_argument("-t", "--threshold", type=float, default=0.2,
+                              help="The maximum allowed throughput regression (default: 0.2)")
+    parser_micro.add_argument("-s", "--save-baseline", type=str, help="Saves the results as a baseline file")
+    parser_micro.set_defaults(func=micro)
+
+    for p in (parser_startup, parser_load, parser_micro):
+        p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
+
+    args = parser.parse_args()
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+    logger.handlers = [sh]
+
+    try:
+        args.func(args)
+    except BenchmarkError as e:
+        logging.error(e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
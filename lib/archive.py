@@ -0,0 +1,89 @@
+import base64
+import gzip
+import io
+import json
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests import exceptions
+from urllib3 import HTTPResponse
+
+# Headers which no longer apply once the content is stored decoded
+_IGNORED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class Archive(object):
+    def __init__(self, path):
+        # type: (str) -> None
+        self._path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(method, url):
+        return "{} {}".format(method, url)
+
+    def load(self):
+        with gzip.open(self._path, "rt") as f:
+            self._entries = json.load(f)
+
+    def save(self):
+        with self._lock:
+            with gzip.open(self._path, "wt") as f:
+                json.dump(self._entries, f, separators=(",", ":"))
+
+    def add(self, method, url, status, reason, headers, content):
+        with self._lock:
+            self._entries[self._key(method, url)] = dict(
+                status=status, reason=reason, content=base64.b64encode(content).decode("ascii"),
+                headers={k: v for k, v in headers.items() if k.lower() not in _IGNORED_HEADERS})
+
+    def get(self, method, url):
+        entry = self._entries.get(self._key(method, url))
+        if entry is None:
+            return None
+        content = base64.b64decode(entry["content"])
+        headers = dict(entry["headers"], **{"Content-Length": str(len(content))})
+        return HTTPResponse(body=io.BytesIO(content), headers=headers, status=entry["status"],
+                            reason=entry["reason"], preload_content=False, decode_content=False)
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, archive, **kwargs):
+        # type: (Archive, any) -> None
+        super(RecordingAdapter, self).__init__(**kwargs)
+        self._archive = archive
+
+    def send(self, request, **kwargs):
+        response = super(RecordingAdapter, self).send(request, **kwargs)
+        self._archive.add(request.method, request.url, response.status_code, response.reason, response.headers,
+                          response.content)
+        # Serve the recorded entry, so recording and replaying behave exactly the same
+        return self.build_response(request, self._archive.get(request.method, request.url))
+
+
+class ReplayAdapter(HTTPAdapter):
+    def __init__(self, archive, **kwargs):
+        # type: (Archive, any) -> None
+        super(ReplayAdapter, self).__init__(**kwargs)
+        self._archive = archive
+
+    def send(self, request, **kwargs):
+        raw = self._archive.get(request.method, request.url)
+        if raw is None:
+            raise exceptions.ConnectionError(
+                "No recorded response for {} {}".format(request.method, request.url), request=request)
+        return self.build_response(request, raw)
+
+
+def mount_archive(session, archive, replay=False):
+    adapter = ReplayAdapter(archive) if replay else RecordingAdapter(archive)
+    for prefix in ("http://", "https://"):
+        session.mount(prefix, adapter)
@@ -0,0 +1,46 @@
+import threading
+from collections import defaultdict
+
+
+class _Counters(object):
+    __slots__ = ("requests", "wire", "decoded", "duration")
+
+    def __init__(self):
+        self.requests = self.wire = self.decoded = 0
+        self.duration = 0.0
+
+
+class Bandwidth(object):
+    # Counts the bytes transferred by each provider: as received on the wire (compressed) and once decoded, along with
+    # the time spent downloading the bodies
+    def __init__(self):
+        self._counters = defaultdict(_Counters)
+        self._lock = threading.Lock()
+
+    def add(self, provider, wire, decoded, duration):
+        with self._lock:
+            c = self._counters[provider]
+            c.requests += 1
+            c.wire += wire
+            c.decoded += decoded
+            c.duration += duration
+
+    def scope(self, provider):
+        return _Scope(self, provider)
+
+    def summary(self):
+        # type: () -> list[(str, int, int, int, float)]
+        # Rows of (provider, requests, wire bytes, decoded bytes, download seconds)
+        with self._lock:
+            return sorted((provider, c.requests, c.wire, c.decoded, c.duration)
+                          for provider, c in self._counters.items())
+
+
+class _Scope(object):
+    # The counters of a single provider
+    def __init__(self, bandwidth, provider):
+        self._bandwidth = bandwidth
+        self._provider = provider
+
+    def add(self, wire, decoded, duration):
+        self._bandwidth.add(self._provider, wire, decoded, duration)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_replace = getattr(os, "replace", os.rename)
+
+
+class MemoryCache(object):
+    def __init__(self, ttl, max_entries=256):
+        # type: (float, int) -> None
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert the entry so the least recently used ones are evicted first
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self._ttl, value)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileCache(object):
+    def __init__(self, path, ttl, max_entries=256):
+        # type: (str, float, int) -> None
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+
+    def _get_path(self, key):
+        return os.path.join(self._path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, key):
+        path = self._get_path(key)
+        try:
+            if os.path.getmtime(path) + self._ttl < time.time():
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        path = self._get_path(key)
+        # Write to a temporary file first, so other processes never read a partial entry
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        _replace(tmp_path, path)
+        self._evict()
+
+    def _entries(self):
+        return [os.path.join(self._path, name) for name in os.listdir(self._path) if name.endswith(".json")]
+
+    def _evict(self):
+        entries = self._entries()
+        if len(entries) > self._max_entries:
+            entries.sort(key=os.path.getmtime)
+            for path in entries[:len(entries) - self._max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for path in self._entries():
+            os.remove(path)
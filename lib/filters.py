@@ -6,8 +6,27 @@ Result = namedtuple("Result", "name factor")
 Unknown = Result("Unknown", 0)
 
 
+# Compiled on first use, so importing the filters does not pay for all the patterns
+class _LazyRegex(object):
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self._flags = flags
+        self._regex = None
+
+    def _compiled(self):
+        if self._regex is None:
+            self._regex = re.compile(self.pattern, flags=self._flags)
+        return self._regex
+
+    def search(self, string):
+        return self._compiled().search(string)
+
+    def finditer(self, string):
+        return self._compiled().finditer(string)
+
+
 def _compile(pattern):
-    return re.compile(r"(?:\b|_)(?:{})".format(pattern), flags=re.IGNORECASE)
+    return _LazyRegex(r"(?:\b|_)(?:{})".format(pattern), flags=re.IGNORECASE)
 
 
 class FilterBase(object):
@@ -77,3 +96,31 @@ class AudioCodec(FilterBase):
     c_dts_hd_ma = Filter("DTS HD MA", _compile("dts[^a-zA-z0-9]+hd[^a-zA-z0-9]+ma"))
 
     values = (c_mp3, c_aac, c_ac3, c_dts, c_dts_hd, c_dts_hd_ma)
+
+
+EPISODE = "episode"
+SEASON_PACK = "season_pack"
+
+_episode_re = _compile(r"s(\d{1,2})[ ._-]?e(\d{1,3})(?:(?:-e?|e)(\d{1,3}))?(?!\d)|(\d{1,2})x(\d{2,3})(?!\d)")
+_season_re = _compile(r"(?:s|season[ ._-]?)(\d{1,2})(?:[ ._-]?-[ ._-]?s?(\d{1,2}))?(?!\d|[ ._-]?e\d)")
+
+
+def match_episode(title, season, episode):
+    has_episodes = False
+    for match in _episode_re.finditer(title):
+        has_episodes = True
+        if match.group(1) is None:
+            match_season, first, last = int(match.group(4)), int(match.group(5)), None
+        else:
+            match_season, first, last = int(match.group(1)), int(match.group(2)), match.group(3)
+        if match_season == season and first <= episode <= (first if last is None else int(last)):
+            return EPISODE
+
+    if not has_episodes:
+        for match in _season_re.finditer(title):
+            first = int(match.group(1))
+            last = first if match.group(2) is None else int(match.group(2))
+            if first <= season <= last:
+                return SEASON_PACK
+
+    return None
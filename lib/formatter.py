@@ -91,7 +91,3 @@ class ExtendedFormatter(Formatter):
             return node.n
 
         raise ValueError("Unsupported argument: {}".format(node))
-
-
-f = ExtendedFormatter()
-print(f.format("{a:replace('a','b').replace('b','B')}", a="1a2a3"))
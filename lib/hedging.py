@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from collections import deque
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Cancellation(object):
+    # An event which also runs callbacks when set, so the losing calls can give back what they hold right away,
+    # without waiting to notice it
+    def __init__(self):
+        self._callbacks = []
+        self._set = False
+        self._lock = threading.Lock()
+
+    def is_set(self):
+        return self._set
+
+    def add_callback(self, callback):
+        # Runs callback right away if already set
+        with self._lock:
+            if not self._set:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def set(self):
+        with self._lock:
+            if self._set:
+                return
+            self._set = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning("Cancellation callback failed: %s", e)
+
+
+class LatencyTracker(object):
+    def __init__(self, size=100, min_samples=10):
+        self._latencies = deque(maxlen=size)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percent):
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(percent / 100.0 * len(latencies)))]
+
+
+def _start(func, *args):
+    # Runs func in a new thread. The losing calls are left to finish on their own, so they can't block other calls
+    from concurrent.futures import Future
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+class Hedger(object):
+    def __init__(self, rate=0.1, percent=90):
+        # type: (float, int) -> None
+        self._rate = rate
+        self._percent = percent
+        self._trackers = {}
+        self._requests = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def _get_tracker(self, key):
+        with self._lock:
+            self._requests += 1
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                tracker = self._trackers[key] = LatencyTracker()
+            return tracker
+
+    def _acquire(self):
+        # At most rate of all requests can be hedged, so the load on providers is never doubled
+        with self._lock:
+            if self._hedges + 1 > self._requests * self._rate:
+                return False
+            self._hedges += 1
+            return True
+
+    def call(self, key, func):
+        # type: (any, callable) -> any
+        # Calls func(cancelled). If it does not complete within the observed latency percentile for the provided key,
+        # a duplicate call is started and the first one to complete wins. The other call is asked to stop through the
+        # cancelled Cancellation, and must raise Cancelled as soon as it notices it.
+        tracker = self._get_tracker(key)
+        delay = tracker.percentile(self._percent)
+        cancelled = Cancellation()
+        start = _clock()
+
+        if delay is None:
+            result = func(cancelled)
+            tracker.add(_clock() - start)
+            return result
+
+        from concurrent.futures import FIRST_COMPLETED, wait
+        futures = [_start(func, cancelled)]
+        done, _ = wait(futures, timeout=delay)
+        if not done and self._acquire():
+            logging.debug("Hedging request for %s after %.0fms", key, delay * 1000)
+            futures.append(_start(func, cancelled))
+
+        try:
+            pending = futures
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None or not pending:
+                        tracker.add(_clock() - start)
+                        return future.result()
+        finally:
+            cancelled.set()
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import threading
+
+import httpx
+
+# httpx logs every request at the INFO level
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class _Response(object):
+    # Exposes the subset of the requests.Response interface used by the scrapers
+    def __init__(self, session, response):
+        # type: (Http2Session, httpx.Response) -> None
+        self._session = session
+        self._response = response
+
+    @property
+    def status_code(self):
+        return self._response.status_code
+
+    @property
+    def headers(self):
+        return self._response.headers
+
+    @property
+    def url(self):
+        return str(self._response.url)
+
+    @property
+    def http_version(self):
+        return self._response.http_version
+
+    @property
+    def num_bytes_downloaded(self):
+        # The size of the body before being decoded
+        return self._response.num_bytes_downloaded
+
+    @property
+    def content(self):
+        return self._session._run(self._response.aread())
+
+    def iter_content(self, chunk_size=1):
+        chunks = self._response.aiter_bytes(chunk_size)
+        while True:
+            try:
+                yield self._session._run(chunks.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+    def close(self):
+        self._session._run(self._response.aclose())
+
+
+class Http2Session(object):
+    # Multiplexes all requests to the same host over a single HTTP/2 connection. Hosts which do not support HTTP/2
+    # (negotiated with ALPN) are requested using HTTP/1.1. With prior_knowledge, HTTP/2 is used on plain http:// urls.
+    # HTTP/2 connections can't be shared between threads, so they are all driven by an event loop on its own thread
+    def __init__(self, headers=None, pool_size=None, prior_knowledge=False):
+        # Raises ImportError when the h2 package is not available
+        import h2  # noqa: F401
+
+        self._client = httpx.AsyncClient(
+            http1=not prior_knowledge, http2=True, headers=headers, follow_redirects=True,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    @property
+    def headers(self):
+        return self._client.headers
+
+    def _send(self, method, url, timeout=None, stream=False, allow_redirects=True):
+        request = self._client.build_request(method, url, timeout=timeout)
+        return _Response(self, self._run(self._client.send(request, stream=stream, follow_redirects=allow_redirects)))
+
+    def get(self, url, timeout=None, stream=False, allow_redirects=True):
+        return self._send("GET", url, timeout=timeout, stream=stream, allow_redirects=allow_redirects)
+
+    def head(self, url, timeout=None, allow_redirects=False):
+        return self._send("HEAD", url, timeout=timeout, allow_redirects=allow_redirects)
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        try:
+            self._run(self._client.aclose())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from lib.filters import Resolution, ReleaseType
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    info_hash TEXT PRIMARY KEY, title TEXT NOT NULL, magnet TEXT NOT NULL, size TEXT,
+    resolution TEXT, release TEXT, updated_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS torrents_updated_at ON torrents (updated_at);
+CREATE TABLE IF NOT EXISTS sources (
+    info_hash TEXT NOT NULL, provider TEXT NOT NULL, seeds INTEGER, leeches INTEGER, updated_at REAL NOT NULL,
+    PRIMARY KEY (info_hash, provider));
+CREATE TABLE IF NOT EXISTS history (
+    info_hash TEXT NOT NULL, provider TEXT NOT NULL, seeds INTEGER, leeches INTEGER, time REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS history_info_hash ON history (info_hash);
+CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, updated_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS search_results (
+    key TEXT NOT NULL, info_hash TEXT NOT NULL, provider TEXT NOT NULL, PRIMARY KEY (key, info_hash, provider));
+CREATE INDEX IF NOT EXISTS search_results_info_hash ON search_results (info_hash);
+"""
+
+
+def _int(value):
+    try:
+        return None if value is None else int(value)
+    except ValueError:
+        return None
+
+
+def search_key(search_type, data):
+    # Media searches are identified by their TMDB id (when available), so they survive changes in the titles
+    if search_type == "query":
+        return "query:" + data.strip().lower()
+    parts = [search_type, "tmdb:{}".format(data["tmdb_id"]) if data.get("tmdb_id") else data["title"].lower()]
+    parts.extend(str(data[field]) for field in ("year", "season", "episode") if data.get(field))
+    return ":".join(parts)
+
+
+class Index(object):
+    def __init__(self, path, max_age=30 * 24 * 60 * 60, max_entries=20000):
+        # type: (str, float, int) -> None
+        self._path = path
+        self._max_age = max_age
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._initialized = False
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=10)
+        if not self._initialized:
+            with self._lock:
+                if not self._initialized:
+                    conn.executescript(_SCHEMA)
+                    self._initialized = True
+        return conn
+
+    def get(self, key):
+        # type: (str) -> (float, list[(str, dict)]) | None
+        # Returns when the search was last updated and its (provider, result) pairs
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT updated_at FROM searches WHERE key = ?", (key,)).fetchone()
+            if row is None or row[0] + self._max_age < time.time():
+                return None
+            results = [(provider, dict(title=title, magnet=magnet, size=size, seeds=seeds, leeches=leeches))
+                       for provider, title, magnet, size, seeds, leeches in conn.execute(
+                           "SELECT r.provider, t.title, t.magnet, t.size, s.seeds, s.leeches FROM search_results r "
+                           "JOIN torrents t ON t.info_hash = r.info_hash "
+                           "JOIN sources s ON s.info_hash = r.info_hash AND s.provider = r.provider "
+                           "WHERE r.key = ?", (key,))]
+            return row[0], results
+
+    def update(self, key, results):
+        # type: (str, list[(str, str, dict)]) -> None
+        # Replaces the search results with the provided (provider, info_hash, result) tuples
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO searches (key, updated_at) VALUES (?, ?)", (key, now))
+            conn.execute("DELETE FROM search_results WHERE key = ?", (key,))
+            for provider, info_hash, result in results:
+                title = result["title"]
+                seeds, leeches = _int(result.get("seeds")), _int(result.get("leeches"))
+                conn.execute(
+                    "INSERT OR REPLACE INTO torrents (info_hash, title, magnet, size, resolution, release, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (info_hash, title, result["magnet"], result.get("size"),
+                                                     Resolution.match(title).name, ReleaseType.match(title).name, now))
+                conn.execute("INSERT OR REPLACE INTO sources (info_hash, provider, seeds, leeches, updated_at) "
+                             "VALUES (?, ?, ?, ?, ?)", (info_hash, provider, seeds, leeches, now))
+                if seeds is not None or leeches is not None:
+                    conn.execute("INSERT INTO history (info_hash, provider, seeds, leeches, time) "
+                                 "VALUES (?, ?, ?, ?, ?)", (info_hash, provider, seeds, leeches, now))
+                conn.execute("INSERT OR IGNORE INTO search_results (key, info_hash, provider) VALUES (?, ?, ?)",
+                             (key, info_hash, provider))
+            self._evict(conn, now)
+
+    def history(self, info_hash):
+        # type: (str) -> list[(float, str, int, int)]
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT time, provider, seeds, leeches FROM history WHERE info_hash = ? ORDER BY time",
+                                (info_hash,)).fetchall()
+
+    def _evict(self, conn, now):
+        # Torrents are evicted when they were not seen for max_age, or when there are more than max_entries
+        evicted = conn.execute("DELETE FROM searches WHERE updated_at < ?", (now - self._max_age,)).rowcount
+        evicted += conn.execute("DELETE FROM torrents WHERE updated_at < ?", (now - self._max_age,)).rowcount
+        evicted += conn.execute("DELETE FROM torrents WHERE info_hash IN (SELECT info_hash FROM torrents "
+                                "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)", (self._max_entries,)).rowcount
+        if evicted:
+            for table in ("sources", "history", "search_results"):
+                conn.execute("DELETE FROM {} WHERE info_hash NOT IN (SELECT info_hash FROM torrents)".format(table))
+            conn.execute("DELETE FROM search_results WHERE key NOT IN (SELECT key FROM searches)")
+
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            for table in ("torrents", "sources", "history", "searches", "search_results"):
+                conn.execute("DELETE FROM {}".format(table))
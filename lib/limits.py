@@ -0,0 +1,238 @@
+import json
+import threading
+import time
+from collections import deque
+
+from lib.hedging import LatencyTracker
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+class RateLimited(Exception):
+    pass
+
+
+def parse_retry_after(value):
+    # type: (str | None) -> float | None
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        # email is only needed for dates, which few providers send
+        from email.utils import mktime_tz, parsedate_tz
+        date = parsedate_tz(value)
+        return None if date is None else max(0.0, mktime_tz(date) - time.time())
+
+
+class Limiter(object):
+    def __init__(self, max_connections=None, rate=None, burst=None, retries=2, backoff=1.0):
+        # type: (int | None, float | None, int | None, int, float) -> None
+        self._max_connections = max_connections
+        self._rate = rate
+        self._burst = burst or max(1, int(rate or 1))
+        self.retries = retries
+        self._backoff = backoff
+        self._connections = 0
+        self._tokens = self._burst
+        self._updated_at = _clock()
+        self._resume_at = 0
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        if self._rate is not None:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def acquire(self, timeout=None):
+        # Waits until the provider can take another request. Fails right away if that would take longer than timeout
+        deadline = None if timeout is None else _clock() + timeout
+        with self._condition:
+            while True:
+                now = _clock()
+                self._refill(now)
+                if self._resume_at > now:
+                    delay = self._resume_at - now
+                elif self._max_connections is not None and self._connections >= self._max_connections:
+                    # Wait for a connection to be released
+                    delay = None
+                elif self._rate is not None and self._tokens < 1:
+                    delay = (1 - self._tokens) / self._rate
+                else:
+                    if self._rate is not None:
+                        self._tokens -= 1
+                    self._connections += 1
+                    return
+
+                if deadline is not None:
+                    if now >= deadline or (delay is not None and now + delay > deadline):
+                        raise RateLimited("Provider limits exceeded the timeout")
+                    delay = deadline - now if delay is None else delay
+                self._condition.wait(delay)
+
+    def release(self):
+        with self._condition:
+            self._connections -= 1
+            self._condition.notify()
+
+    def backoff(self, attempt, retry_after=None):
+        # type: (int, float | None) -> float
+        # Pauses all requests to the provider, either for the time it asked for or with an exponential backoff
+        delay = self._backoff * 2 ** attempt if retry_after is None else retry_after
+        with self._condition:
+            self._resume_at = max(self._resume_at, _clock() + delay)
+            self._condition.notify_all()
+        return delay
+
+
+class AdaptiveLimit(object):
+    # Additive increase, multiplicative decrease: the limit grows by one for each limit requests completed while it is
+    # fully used, and is cut by decrease when the requests are overloaded, or when their latency rises for a while:
+    # the median of the last window latencies must be above tolerance times the usual median latency, and at least
+    # min_increase seconds above it. Requests started before the last decrease can't decrease it again, as failures
+    # usually come in bursts. Throttled requests can also pause the acquisitions (see backoff)
+    def __init__(self, max_limit, limit=None, decrease=0.5, tolerance=3.0, window=10, min_increase=0.5):
+        # type: (int, float | None, float, float | None, int, float) -> None
+        self._max_limit = max_limit
+        self._decrease = decrease
+        self._tolerance = tolerance
+        self._min_increase = min_increase
+        self.limit = float(min(max_limit, max(1, limit or max_limit)))
+        # The limit before being cut by latency alone, as a slow period must not carry into the next searches
+        self._restore_limit = None
+        self._in_flight = 0
+        self._resume_at = 0
+        self._latencies = LatencyTracker(min_samples=2 * window)
+        self._recent = deque(maxlen=window)
+        self._decreased_at = None
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else _clock() + timeout
+        with self._condition:
+            while True:
+                now = _clock()
+                if self._resume_at > now:
+                    delay = self._resume_at - now
+                elif self._in_flight >= int(self.limit):
+                    # Wait for a request to be released
+                    delay = None
+                else:
+                    self._in_flight += 1
+                    return
+
+                if deadline is not None:
+                    if now >= deadline or (delay is not None and now + delay > deadline):
+                        raise RateLimited("Concurrency limit exceeded the timeout")
+                    delay = deadline - now if delay is None else delay
+                self._condition.wait(delay)
+
+    def backoff(self, delay):
+        # type: (float) -> None
+        with self._condition:
+            self._resume_at = max(self._resume_at, _clock() + delay)
+            self._condition.notify_all()
+
+    @property
+    def saved_limit(self):
+        # The limit to start the next searches from
+        return self.limit if self._restore_limit is None else max(self.limit, self._restore_limit)
+
+    def _congested(self):
+        if self._tolerance is None or len(self._recent) < self._recent.maxlen:
+            return False
+        usual = self._latencies.percentile(50)
+        recent = sorted(self._recent)[len(self._recent) // 2]
+        return usual is not None and recent > usual * self._tolerance and recent - usual >= self._min_increase
+
+    def release(self, start=None, latency=None, overloaded=False):
+        # type: (float | None, float | None, bool) -> None
+        with self._condition:
+            saturated = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            if latency is not None and not overloaded:
+                self._recent.append(latency)
+            congested = not overloaded and self._congested()
+            if overloaded or congested:
+                if self._decreased_at is None or start is None or start >= self._decreased_at:
+                    if not congested:
+                        self._restore_limit = None
+                    elif self._restore_limit is None:
+                        self._restore_limit = self.limit
+                    self.limit = max(1.0, self.limit * self._decrease)
+                    self._decreased_at = _clock()
+                    # The latencies after the decrease have to show the congestion again
+                    self._recent.clear()
+            elif latency is not None and saturated:
+                # Only grow while the limit is what holds the requests back
+                self.limit = min(self._max_limit, self.limit + 1.0 / self.limit)
+            if latency is not None and not overloaded:
+                self._latencies.add(latency)
+            self._condition.notify_all()
+
+
+class Concurrency(object):
+    # Adapts the number of concurrent requests, both to each host and in total, up to max_limit. Hosts limits react to
+    # throttling and latency, while the total limit only reacts to failed requests (timeouts, resets), as latencies
+    # differ too much between hosts. The limits can be saved, so the next searches start from them
+    def __init__(self, max_limit, limits=None, retries=2, backoff=1.0):
+        # type: (int, dict | None, int, float) -> None
+        limits = limits or {}
+        self._max_limit = max_limit
+        self.retries = retries
+        self._backoff = backoff
+        self._total = AdaptiveLimit(max_limit, limits.get("total", max_limit), tolerance=None)
+        self._initial_limits = limits.get("hosts", {})
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_limit(self, host):
+        with self._lock:
+            limit = self._hosts.get(host)
+            if limit is None:
+                limit = self._hosts[host] = AdaptiveLimit(self._max_limit, self._initial_limits.get(host))
+            return limit
+
+    def acquire(self, host, timeout=None):
+        deadline = None if timeout is None else _clock() + timeout
+        host_limit = self._get_limit(host)
+        host_limit.acquire(timeout)
+        try:
+            self._total.acquire(None if deadline is None else max(0, deadline - _clock()))
+        except RateLimited:
+            host_limit.release()
+            raise
+
+    def release(self, host, start=None, latency=None, overloaded=False, failed=False):
+        # type: (str, float | None, float | None, bool, bool) -> None
+        # start is the time (from clock) when the request was sent
+        self._total.release(start, latency, failed)
+        self._get_limit(host).release(start, latency, overloaded or failed)
+
+    def backoff(self, host, attempt, retry_after=None):
+        # type: (str, int, float | None) -> float
+        # Pauses the requests to the host, either for the time it asked for or with an exponential backoff
+        delay = self._backoff * 2 ** attempt if retry_after is None else retry_after
+        self._get_limit(host).backoff(delay)
+        return delay
+
+    @property
+    def limits(self):
+        with self._lock:
+            hosts = {host: limit.saved_limit for host, limit in self._hosts.items()}
+        return dict(total=self._total.saved_limit, hosts=dict(self._initial_limits, **hosts))
+
+    @classmethod
+    def load(cls, path, max_limit):
+        # type: (str, int) -> Concurrency
+        try:
+            with open(path) as f:
+                limits = json.load(f)
+        except (IOError, OSError, ValueError):
+            limits = None
+        return cls(max_limit, limits)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.limits, f)
@@ -0,0 +1,99 @@
+import logging
+import sys
+import threading
+from collections import defaultdict
+
+
+def sizeof_result(result):
+    # type: (dict) -> int
+    return sys.getsizeof(result) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in result.items())
+
+
+class _Stage(object):
+    __slots__ = ("count", "allocated", "retained", "peak")
+
+    def __init__(self):
+        self.count = self.allocated = self.retained = self.peak = 0
+
+
+class MemoryAccount(object):
+    # Accounts the memory held by a search, per provider and stage: the pages being parsed (their bodies, trees and
+    # parents maps), the rows kept for the cache and the merged results. The sizes are measured from the objects, not
+    # from the allocator, so they can be tracked while searches run concurrently. When a ceiling (in bytes) is set,
+    # the search degrades once the held memory exceeds it, by skipping the remaining pages and dropping the lowest
+    # ranked results
+    def __init__(self, ceiling=None):
+        # type: (int | None) -> None
+        self.ceiling = ceiling
+        self.degraded = False
+        self._used = 0
+        self._peak = 0
+        self._stages = defaultdict(_Stage)
+        self._lock = threading.Lock()
+
+    @property
+    def used(self):
+        return self._used
+
+    @property
+    def peak(self):
+        return self._peak
+
+    @property
+    def exceeded(self):
+        return self.ceiling is not None and self._used >= self.ceiling
+
+    def add(self, provider, stage, size, count=1):
+        with self._lock:
+            self._used += size
+            self._peak = max(self._peak, self._used)
+            s = self._stages[(provider, stage)]
+            s.count += count
+            s.allocated += size
+            s.retained += size
+            s.peak = max(s.peak, s.retained)
+
+    def remove(self, provider, stage, size):
+        with self._lock:
+            self._used -= size
+            self._stages[(provider, stage)].retained -= size
+
+    def degrade(self, reason, *args):
+        # Only the first degradation is logged, as it usually repeats for every provider
+        if not self.degraded:
+            self.degraded = True
+            logging.warning("Search memory ceiling exceeded, " + reason, *args)
+
+    def scope(self, provider):
+        return _Scope(self, provider)
+
+    def summary(self):
+        # type: () -> list[(str, str, int, int, int, int)]
+        # Rows of (provider, stage, count, allocated bytes, peak bytes, retained bytes)
+        with self._lock:
+            return sorted((provider, stage, s.count, s.allocated, s.peak, s.retained)
+                          for (provider, stage), s in self._stages.items())
+
+
+class _Scope(object):
+    # The account of a single provider
+    def __init__(self, account, provider):
+        self._account = account
+        self._provider = provider
+
+    @property
+    def exceeded(self):
+        return self._account.exceeded
+
+    @property
+    def degraded(self):
+        return self._account.degraded
+
+    def add(self, stage, size, count=1):
+        self._account.add(self._provider, stage, size, count=count)
+
+    def remove(self, stage, size):
+        self._account.remove(self._provider, stage, size)
+
+    def degrade(self, reason, *args):
+        self._account.degrade(reason, *args)
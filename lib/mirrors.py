@@ -0,0 +1,187 @@
+import json
+import logging
+import threading
+import time
+from contextlib import closing
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urlparse import urlparse
+
+try:
+    from queue import Queue
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from Queue import Queue
+
+
+def _origin(url):
+    url = urlparse(url)
+    return url.scheme, url.netloc
+
+
+class Mirrors(object):
+    # The base urls of a provider which runs several mirrors. All the provider parsers share the same instance, so
+    # they all switch to another mirror at once. The current mirror is chosen by probing the mirrors, and is probed
+    # again once older than max_age. A mirror which fails is not used again for retry_after seconds
+    def __init__(self, urls, current=None, chosen_at=None, max_age=24 * 60 * 60, retry_after=10 * 60):
+        # type: (list[str], str | None, float | None, float, float) -> None
+        if not urls:
+            raise ValueError("At least one mirror is required")
+        self.urls = list(urls)
+        self.max_age = max_age
+        self.retry_after = retry_after
+        if current in self.urls:
+            self._current, self.chosen_at = current, chosen_at
+        else:
+            self._current, self.chosen_at = self.urls[0], None
+        self._failed = {}
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        return self._current
+
+    @property
+    def stale(self):
+        return self.chosen_at is None or self.chosen_at + self.max_age < time.time()
+
+    def _is_healthy(self, url, now):
+        failed_at = self._failed.get(url)
+        return failed_at is None or failed_at + self.retry_after < now
+
+    def mirror_of(self, url):
+        # The mirror url belongs to, if any. Mirrors on the same host are told apart by their path
+        origin = _origin(url)
+        path = urlparse(url).path
+        mirrors = [m for m in self.urls if _origin(m) == origin]
+        mirrors.sort(key=lambda m: path.startswith(urlparse(m).path.rstrip("/")) and len(urlparse(m).path),
+                     reverse=True)
+        return mirrors[0] if mirrors else None
+
+    def rebase(self, url, mirror):
+        # Moves url from the mirror it belongs to into mirror, keeping its path relative to the mirror
+        old = self.mirror_of(url)
+        if old is None or old == mirror:
+            return url
+        url, old, new = urlparse(url), urlparse(old), urlparse(mirror)
+        old_path, new_path = old.path.rstrip("/"), new.path.rstrip("/")
+        path = new_path + url.path[len(old_path):] if url.path.startswith(old_path) else url.path
+        return url._replace(scheme=new.scheme, netloc=new.netloc, path=path).geturl()
+
+    def redirect(self, url):
+        # Moves url to the current mirror when the mirror it belongs to failed recently, so it is not tried again
+        mirror = self.mirror_of(url)
+        now = time.time()
+        current = self._current
+        if mirror is None or mirror == current or self._is_healthy(mirror, now) or not self._is_healthy(current, now):
+            return url
+        return self.rebase(url, current)
+
+    def fail(self, url, excluded=()):
+        # Marks the mirror of url as failed and switches to the next healthy mirror (if still using it). Returns the
+        # mirror to use instead, or None when there is no other healthy mirror
+        mirror = self.mirror_of(url)
+        now = time.time()
+        with self._lock:
+            if mirror is not None:
+                self._failed[mirror] = now
+            if self._current == mirror:
+                start = self.urls.index(mirror) + 1
+                for candidate in self.urls[start:] + self.urls[:start]:
+                    if candidate != mirror and self._is_healthy(candidate, now):
+                        logging.warning("Mirror %s failed, switching to %s", mirror, candidate)
+                        # Not chosen by latency, so it is probed again on the next warm up
+                        self._current, self.chosen_at = candidate, None
+                        break
+            current = self._current
+        if current == mirror or current in excluded or not self._is_healthy(current, now):
+            return None
+        return current
+
+    def probe(self, session=None, timeout=None):
+        # Races a lightweight request to each healthy mirror, and switches to the first one answering without a server
+        # error. The others are left to finish in background. Returns the chosen mirror, if any. Only one probe runs at
+        # a time, the others return None right away
+        if session is None:
+            import requests
+            session = requests
+        now = time.time()
+        with self._lock:
+            if self._probing:
+                return None
+            self._probing = True
+            urls = [url for url in self.urls if self._is_healthy(url, now)]
+        try:
+            return self._probe(session, timeout, urls)
+        finally:
+            with self._lock:
+                self._probing = False
+
+    def _probe(self, session, timeout, urls):
+        answers = Queue()
+
+        def run(url):
+            try:
+                with closing(session.head(url, timeout=timeout, allow_redirects=False)) as r:
+                    # 501 only means the server does not support HEAD requests
+                    answers.put((url, r.status_code < 500 or r.status_code == 501))
+            except Exception as e:
+                logging.debug("Mirror %s probe failed: %s", url, e)
+                answers.put((url, False))
+
+        for url in urls:
+            thread = threading.Thread(target=run, args=(url,))
+            thread.daemon = True
+            thread.start()
+
+        for _ in urls:
+            url, healthy = answers.get()
+            with self._lock:
+                if healthy:
+                    logging.debug("Using mirror %s", url)
+                    self._current, self.chosen_at = url, time.time()
+                    return url
+                self._failed[url] = time.time()
+        return None
+
+
+class MirrorChoices(object):
+    # The mirror chosen for each provider (and when it was chosen), kept between runs
+    def __init__(self, choices=None):
+        # type: (dict[str, (str, float | None)]) -> None
+        self._choices = dict(choices or {})
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        # type: (str) -> (str | None, float | None)
+        return self._choices.get(name, (None, None))
+
+    def update(self, name, mirrors):
+        # type: (str, Mirrors) -> bool
+        # Returns whether the choice changed
+        choice = (mirrors.current, mirrors.chosen_at)
+        with self._lock:
+            if self._choices.get(name) == choice:
+                return False
+            self._choices[name] = choice
+            return True
+
+    @classmethod
+    def load(cls, path):
+        # type: (str) -> MirrorChoices
+        try:
+            with open(path) as f:
+                choices = json.load(f)
+        except (IOError, OSError, ValueError):
+            choices = None
+        return cls({name: tuple(choice) for name, choice in (choices or {}).items()})
+
+    def save(self, path):
+        with self._lock:
+            choices = dict(self._choices)
+        with open(path, "w") as f:
+            json.dump(choices, f)
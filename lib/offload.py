@@ -0,0 +1,71 @@
+import logging
+import threading
+
+from lib.parsers import HTMLParser, JSONParser, RegexParser, XMLParser
+
+PARSERS = {"html": HTMLParser, "json": JSONParser, "xml": XMLParser, "regex": RegexParser}
+
+
+def extract_from(parser, rows, data, next_page_xpath=None):
+    # type: (ETParser, str | None, dict[str, str], str | None) -> (list[dict[str, str]] | dict[str, str], str | None)
+    # Applies the extraction plan to the parsed content, returning plain (picklable) objects.
+    # When rows is None, the returned value is the dict of values to update a single result with.
+    if rows is None:
+        values = {}
+        parser.update_result(data, values)
+    else:
+        values = parser.parse_results(rows, data)
+    next_page = None if next_page_xpath is None else parser.try_get_element(next_page_xpath)
+    return values, next_page
+
+
+# noinspection PyShadowingBuiltins
+def extract(type, content, rows, data, next_page_xpath=None):
+    return extract_from(PARSERS[type](content), rows, data, next_page_xpath)
+
+
+def _initializer():
+    # Import the parsing dependencies upfront, so the first offloaded page does not pay for it
+    import defusedxml.ElementTree  # noqa: F401
+    import htmlement  # noqa: F401
+
+
+class ParsePool(object):
+    def __init__(self, processes=None, threshold=128 * 1024):
+        # type: (int | None, int) -> None
+        self._processes = processes
+        self._threshold = threshold
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def accepts(self, content):
+        return len(content) >= self._threshold
+
+    def _get_pool(self):
+        # The pool is only started once there is something to offload, and then reused for every search
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                logging.debug("Starting parse pool with %s processes", self._processes or "default")
+                try:
+                    self._pool = ProcessPoolExecutor(self._processes, initializer=_initializer)
+                except TypeError:
+                    self._pool = ProcessPoolExecutor(self._processes)
+            return self._pool
+
+    # noinspection PyShadowingBuiltins
+    def extract(self, type, content, rows, data, next_page_xpath=None):
+        return self._get_pool().submit(extract, type, content, rows, data, next_page_xpath).result()
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
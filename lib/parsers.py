@@ -1,13 +1,18 @@
 import json
 import logging
 import re
-from xml.etree.ElementTree import Element, SubElement  # nosec
-
-import htmlement
-from defusedxml import ElementTree
+import sys
 
 from lib.utils import text, PY3
 
+try:
+    from html import unescape
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from HTMLParser import HTMLParser as _HTMLParser
+
+    unescape = _HTMLParser().unescape
+
 
 class ETParser(object):
     _attr_re = re.compile(r"^(.+)/@([a-zA-Z0-9_ ]+)$")
@@ -26,9 +31,12 @@ class ETParser(object):
             self._parents = dict((c, p) for p in self._root.iter() for c in p)
         return self._parents
 
+    def iter_results(self, rows, data, full_elements=False):
+        for element in self._root.iterfind(rows):
+            yield {key: self._xpath_element(element, xpath, full_element=full_elements) for key, xpath in data.items()}
+
     def parse_results(self, rows, data, full_elements=False):
-        return [{key: self._xpath_element(element, xpath, full_element=full_elements) for key, xpath in data.items()}
-                for element in self._root.iterfind(rows)]
+        return list(self.iter_results(rows, data, full_elements=full_elements))
 
     def get_element(self, xpath, full_element=False):
         return self._xpath_element(self._root, xpath, full_element=full_element)
@@ -44,6 +52,23 @@ class ETParser(object):
         for key, xpath in data.items():
             result[key] = self.get_element(xpath)
 
+    def memory_usage(self):
+        # type: () -> dict[str, int]
+        tree = 0
+        for element in self._root.iter():
+            tree += sys.getsizeof(element)
+            for value in (element.text, element.tail):
+                if value:
+                    tree += sys.getsizeof(value)
+            # Accessing attrib would create an empty dict on elements without attributes
+            if element.keys():
+                tree += sys.getsizeof(element.attrib) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                                                            for k, v in element.items())
+        usage = {"tree": tree}
+        if self._parents is not None:
+            usage["parents"] = sys.getsizeof(self._parents)
+        return usage
+
     def _xpath_find(self, element, path):
         paths = self._parents_re.split(path)
         if len(paths) > 1:
@@ -70,23 +95,126 @@ class ETParser(object):
         if tail_match:
             return self._xpath_find(element, tail_match.group(1)).tail
         if full_element:
+            from defusedxml import ElementTree
             return ElementTree.tostring(self._xpath_find(element, path), encoding=self._encoding)
         raise ValueError("Only .../@attr, .../text() and .../tail() paths are supported")
 
 
 class XMLParser(ETParser):
     def __init__(self, content):
+        from defusedxml import ElementTree
         super(XMLParser, self).__init__(ElementTree.fromstring(content))
 
 
+class _ChunksReader(object):
+    # A file-like object reading from an iterator of chunks
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, b"")
+
+
+class XMLStreamParser(ETParser):
+    # Parses the XML document while its chunks are received. Each row is extracted as soon as its element is closed,
+    # and then removed from the tree, so only the elements outside of the rows are kept (i.e, for the next page url).
+    # Data paths are relative to the row, but may still reach its parents
+    _tag_re = re.compile(r"(\{[^}]*\})?[^/{}\[\]]*(?=(\[[^]]*\])*$)")
+
+    def __init__(self, chunks):
+        from defusedxml import ElementTree
+        super(XMLStreamParser, self).__init__(None)
+        self._events = ElementTree.iterparse(_ChunksReader(chunks), events=("start", "end"))
+
+    def iter_results(self, rows, data, full_elements=False):
+        # Only elements with the same tag as the last step of the rows path are checked against it
+        tag = self._tag_re.search(rows).group(0)
+        if tag in ("", ".", "*"):
+            tag = None
+        ancestors = []
+        for event, element in self._events:
+            if event == "start":
+                if self._root is None:
+                    self._root = element
+                ancestors.append(element)
+                continue
+
+            ancestors.pop()
+            if not ancestors or (tag is not None and element.tag != tag):
+                continue
+            # The tree only holds the open elements and the ones outside of the rows, so the lookup is cheap
+            if any(e is element for e in self._root.iterfind(rows)):
+                yield {key: self._xpath_element(element, xpath, full_element=full_elements)
+                       for key, xpath in data.items()}
+                self._parents = None
+                element.clear()
+                ancestors[-1].remove(element)
+
+    def parse_results(self, rows, data, full_elements=False):
+        return list(self.iter_results(rows, data, full_elements=full_elements))
+
+    def get_element(self, xpath, full_element=False):
+        # The remaining of the document is parsed, as the element may come after the rows
+        for _ in self._events:
+            pass
+        return super(XMLStreamParser, self).get_element(xpath, full_element=full_element)
+
+
 class HTMLParser(ETParser):
     def __init__(self, content):
+        import htmlement
         super(HTMLParser, self).__init__(htmlement.fromstring(content))
 
 
+class RegexParser(object):
+    # Extracts the values straight from the content text, without building a tree. Rows is the pattern matching each
+    # row, and each data item is a pattern searched within the row (or within the whole content, when updating a
+    # result). The value is the group named after the data item, or else the first group, or else the whole match
+    _flags = re.DOTALL
+
+    def __init__(self, content):
+        self._text = content.decode("utf-8", "replace") if isinstance(content, bytes) else content
+
+    def _search(self, pattern, content, key=None):
+        match = re.search(pattern, content, self._flags)
+        if match is None:
+            raise ValueError("No match for pattern {}".format(pattern))
+        if key in match.re.groupindex:
+            value = match.group(key)
+        else:
+            value = match.group(1 if match.re.groups else 0)
+        return value if value is None else unescape(value)
+
+    def iter_results(self, rows, data, full_elements=False):
+        for row in re.finditer(rows, self._text, self._flags):
+            row = row.group(0)
+            yield {key: self._search(pattern, row, key) for key, pattern in data.items()}
+
+    def parse_results(self, rows, data, full_elements=False):
+        return list(self.iter_results(rows, data, full_elements=full_elements))
+
+    def get_element(self, pattern, full_element=False):
+        return self._search(pattern, self._text)
+
+    def try_get_element(self, pattern, full_element=False, default=None):
+        try:
+            return self.get_element(pattern, full_element=full_element)
+        except Exception as e:
+            logging.debug("Unable to get element at %s: %s", pattern, e)
+            return default
+
+    def update_result(self, data, result):
+        for key, pattern in data.items():
+            result[key] = self._search(pattern, self._text, key)
+
+    def memory_usage(self):
+        return {"text": sys.getsizeof(self._text)}
+
+
 def create_xml_tree(obj, root_name="root", attribute_type=False):
+    from xml.etree.ElementTree import Element, SubElement  # nosec
     root = Element(root_name)
-    _create_xml_tree(root, obj, attribute_type=attribute_type)
+    _create_xml_tree(root, obj, attribute_type=attribute_type, sub_element=SubElement)
     return root
 
 
@@ -99,18 +227,19 @@ def _check_tag(tag, invalid_xml_tag_re=re.compile(r"[^a-zA-Z0-9-_.]")):
 
 def _create_xml_tree(root, obj, **kwargs):
     attribute_type = kwargs.get("attribute_type", False)
+    sub_element = kwargs["sub_element"]
     tag_str = kwargs.get("tag_str", text)
 
     if isinstance(obj, (tuple, list)):
         for v in obj:
-            _create_xml_tree(SubElement(root, "item"), v, **kwargs)
+            _create_xml_tree(sub_element(root, "item"), v, **kwargs)
     elif isinstance(obj, dict):
         for k, v in obj.items():
             if attribute_type:
                 _kwargs, tag = {"key_type": k.__class__.__name__, "key": tag_str(k)}, "item"
             else:
                 _kwargs, tag = {}, _check_tag(tag_str(k))
-            _create_xml_tree(SubElement(root, tag, **_kwargs), v, **kwargs)
+            _create_xml_tree(sub_element(root, tag, **_kwargs), v, **kwargs)
     else:
         root.text = tag_str(obj)
     if attribute_type:
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from Queue import Queue
+
+
+class Throttle(object):
+    def __init__(self, rate):
+        # type: (float) -> None
+        self._rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        # Each transfer is scheduled after the previous ones, so the average rate never exceeds the limit
+        with self._lock:
+            now = time.time()
+            self._next = max(now, self._next) + size / float(self._rate)
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def throttle_session(session, rate):
+    throttle = Throttle(rate)
+
+    # noinspection PyUnusedLocal
+    def hook(response, *args, **kwargs):
+        # The body is throttled as it is read, which keeps streamed responses streaming
+        iter_content = response.iter_content
+
+        def throttled_iter_content(*a, **kw):
+            for chunk in iter_content(*a, **kw):
+                throttle.consume(len(chunk))
+                yield chunk
+
+        response.iter_content = throttled_iter_content
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+def next_searches(data, next_episode=True, next_season=False):
+    searches = []
+    if next_episode:
+        searches.append(("episode", dict(data, episode=data["episode"] + 1)))
+    if next_season:
+        searches.append(("season", dict(tmdb_id=data["tmdb_id"], title=data["title"], season=data["season"] + 1)))
+    return searches
+
+
+class Prefetcher(object):
+    def __init__(self, prefetch):
+        # type: (callable) -> None
+        self._prefetch = prefetch
+        self._queue = Queue()
+        self._foreground = 0
+        self._closed = False
+        self._idle = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def foreground(self):
+        return _Foreground(self)
+
+    def _enter_foreground(self):
+        with self._idle:
+            self._foreground += 1
+
+    def _exit_foreground(self):
+        with self._idle:
+            self._foreground -= 1
+            self._idle.notify_all()
+
+    def submit(self, search_type, data):
+        self._queue.put((search_type, data))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if self._closed:
+                break
+            # Prefetching only happens when there are no foreground searches running
+            with self._idle:
+                while self._foreground > 0:
+                    self._idle.wait()
+            try:
+                self._prefetch(*item)
+            except Exception as e:
+                logging.warning("Failed prefetching %s search: %s", item[0], e)
+
+    def close(self, timeout=5):
+        # A prefetch still running is abandoned, as it must not hold the service shutdown
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning("Prefetch still running after %ss, not waiting for it", timeout)
+
+
+class _Foreground(object):
+    def __init__(self, prefetcher):
+        self._prefetcher = prefetcher
+
+    def __enter__(self):
+        # noinspection PyProtectedMember
+        self._prefetcher._enter_foreground()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # noinspection PyProtectedMember
+        self._prefetcher._exit_foreground()
+        return False
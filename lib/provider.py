@@ -1,19 +1,43 @@
 import logging
 import os
+import sys
+import threading
+import time
 
 try:
     from urllib import quote_plus
 except ImportError:
     from urllib.parse import quote_plus
 
+from xbmc import Monitor
+from xbmcaddon import Addon
 from xbmcgui import DialogProgressBG
 
+try:
+    from xbmcvfs import translatePath
+except ImportError:
+    from xbmc import translatePath
+
 from flix.kodi import ADDON_PATH, ADDON_NAME, get_boolean_setting, get_int_setting, translate
 from flix.provider import Provider, ProviderResult
+from lib.bandwidth import Bandwidth
+from lib.cache import FileCache, MemoryCache
 from lib.filters import Unknown, Resolution, ReleaseType, SceneTags, VideoCodec, AudioCodec
-from lib.scraper import Scraper, ScraperRunner, default_session
+from lib.hedging import Hedger
+from lib.limits import Concurrency
+from lib.memory import MemoryAccount, sizeof_result
+from lib.mirrors import MirrorChoices
+from lib.prefetch import Prefetcher, next_searches, throttle_session
+from lib.scraper import Scraper, ScraperRunner, default_session, safe_call, warm_up
 from lib.utils import CachedCall, Title, Magnet, InvalidMagnet, resolution_colors, colored_text, bold
 
+PROVIDERS_PATH = os.path.join(ADDON_PATH, "resources", "providers.json")
+ADDON_DATA = translatePath(Addon().getAddonInfo("profile"))
+CONCURRENCY_PATH = os.path.join(ADDON_DATA, "concurrency.json")
+MIRRORS_PATH = os.path.join(ADDON_DATA, "mirrors.json")
+# The results always kept when degrading a search which exceeds the memory ceiling
+MIN_RESULTS = 50
+
 
 class Result(object):
     def __init__(self, scraper, result):
@@ -79,7 +103,7 @@ class Result(object):
     def release(self):
         return self._release
 
-    def to_provider_result(self):
+    def to_provider_data(self):
         label = []
         if self._resolution is not Unknown:
             label.append(bold(colored_text(self._resolution.name, resolution_colors[self._resolution.name])))
@@ -95,7 +119,7 @@ class Result(object):
         label.extend(sorted(self._providers))
         icon = os.path.join(ADDON_PATH, "resources", self._icon) if self._icon else None
 
-        return ProviderResult(
+        return dict(
             label=" ".join(label),
             label2=self._title,
             icon=icon,
@@ -109,7 +133,7 @@ class Result(object):
         return max(seeds * seeds_factor + leeches * leeches_factor, 1) * resolution
 
 
-def include_result(result, get_setting=CachedCall(get_boolean_setting)):
+def include_result(result, get_setting):
     return ((not get_setting("require_size") or bool(result.size)) and
             (not get_setting("require_seeds") or bool(result.seeds)) and
             (not get_setting("require_resolution") or get_setting(
@@ -118,45 +142,268 @@ def include_result(result, get_setting=CachedCall(get_boolean_setting)):
                 "include_release_{}".format(result.release.name.lower()))))
 
 
-def perform_search(search_type, data):
-    results = {}
-    with default_session() as session:
-        scrapers = [s for s in Scraper.get_scrapers(os.path.join(ADDON_PATH, "resources", "providers.json"),
-                                                    timeout=get_int_setting("scraper_timeout"), session=session)
+def get_scrapers(session=None, cache=None, hedger=None, concurrency=None, bandwidth=None, mirror_choices=None):
+    return Scraper.get_scrapers(PROVIDERS_PATH, timeout=get_int_setting("scraper_timeout"), session=session,
+                                cache=cache, hedger=hedger, concurrency=concurrency, bandwidth=bandwidth,
+                                mirror_choices=mirror_choices)
+
+
+def log_bandwidth(bandwidth):
+    for provider, requests, wire, decoded, duration in bandwidth.summary():
+        logging.debug("Provider %s transferred %d bytes (%d decoded) in %d requests, downloading for %.2fs",
+                      provider, wire, decoded, requests, duration)
+
+
+def get_file_cache():
+    # Searches in process only last as long as the plugin call, so the file cache is only worth it for prefetching
+    if not (get_boolean_setting("prefetch_next_episode") or get_boolean_setting("prefetch_next_season")):
+        return None
+    cache_ttl = get_int_setting("cache_ttl")
+    return FileCache(os.path.join(ADDON_DATA, "cache"), cache_ttl * 60) if cache_ttl > 0 else None
+
+
+def get_index():
+    if not get_boolean_setting("enable_index"):
+        return None
+    # sqlite3 is only imported when the index is enabled
+    from lib.index import Index
+    return Index(os.path.join(ADDON_DATA, "index.db"), max_age=get_int_setting("index_max_age") * 24 * 60 * 60)
+
+
+def get_memory_account():
+    ceiling = get_int_setting("memory_ceiling")
+    if ceiling <= 0:
+        return None
+    return MemoryAccount(ceiling * 1024 * 1024)
+
+
+def get_concurrency():
+    # The thread_number setting is the upper bound of the concurrency
+    if not get_boolean_setting("enable_adaptive_concurrency"):
+        return None
+    return Concurrency.load(CONCURRENCY_PATH, get_int_setting("thread_number"))
+
+
+def save_concurrency(concurrency):
+    # The adapted limits are the starting point of the next searches
+    if concurrency is not None:
+        safe_call(None)(concurrency.save)(CONCURRENCY_PATH)
+
+
+def save_mirror_choices(mirror_choices, scrapers):
+    # The mirrors in use are the starting point of the next searches
+    changed = False
+    for scraper in scrapers:
+        if scraper.mirrors is not None:
+            changed = mirror_choices.update(scraper.name, scraper.mirrors) or changed
+    if changed:
+        safe_call(None)(mirror_choices.save)(MIRRORS_PATH)
+
+
+def get_prefetch_session():
+    session = default_session()
+    rate = get_int_setting("prefetch_rate")
+    if rate > 0:
+        throttle_session(session, rate * 1024)
+    return session
+
+
+def prefetch_search(search_type, data, cache):
+    with get_prefetch_session() as session:
+        scrapers = [s for s in get_scrapers(session=session, cache=cache,
+                                            mirror_choices=MirrorChoices.load(MIRRORS_PATH))
                     if get_boolean_setting(s.id)]
+        with ScraperRunner(scrapers, num_threads=get_int_setting("prefetch_threads")) as runner:
+            for scraper, results in runner.parse(search_type, data):
+                logging.debug("Prefetched %d %s results for %s search", len(results), scraper.name, search_type)
 
-        if not scrapers:
-            logging.warning("No scrapers configured/enabled")
-            return None
-
-        runner_class = ProgressScraperRunner if get_boolean_setting("enable_bg_dialog") else ScraperRunner
-        with runner_class(scrapers, num_threads=get_int_setting("thread_number")) as runner:
-            runner_data = runner.parse_query(data) if search_type == "query" else runner.parse(search_type, data)
-
-            for scraper, scraper_results in runner_data:
-                logging.debug("Processing %s scraper results", scraper.name)
-                for scraper_result in scraper_results:
-                    try:
-                        info_hash = Magnet.from_string(scraper_result["magnet"]).info_hash
-                    except InvalidMagnet:
-                        continue
-                    if info_hash == "0" * 40:
-                        continue
-
-                    magnet_result = results.get(info_hash)
-                    if magnet_result is None:
-                        results[info_hash] = Result(scraper, scraper_result)
-                    else:
-                        magnet_result.add_result(scraper, scraper_result)
 
+def merge_results(runner_data, indexed=None, memory=None):
+    results = {}
+    sizes = {}
+    for scraper, scraper_result in runner_data:
+        try:
+            info_hash = Magnet.from_string(scraper_result["magnet"]).info_hash
+        except InvalidMagnet:
+            continue
+        if info_hash == "0" * 40:
+            continue
+        if indexed is not None:
+            indexed.append((scraper.id, info_hash, scraper_result))
+
+        magnet_result = results.get(info_hash)
+        if magnet_result is None:
+            if memory is not None and info_hash in sizes:
+                # Dropped while degrading the search
+                continue
+            magnet_result = results[info_hash] = Result(scraper, scraper_result)
+            if memory is not None:
+                size = sys.getsizeof(magnet_result) + sizeof_result(vars(magnet_result))
+                sizes[info_hash] = (scraper.name, size)
+                memory.add(scraper.name, "results", size)
+                if memory.exceeded:
+                    # Only the excess added by this result is released, as the ceiling may also be exceeded by the
+                    # pages being parsed, which are released once parsed
+                    drop_results(results, sizes, memory, min(memory.used - memory.ceiling, size))
+        else:
+            magnet_result.add_result(scraper, scraper_result)
+    return results
+
+
+def drop_results(results, sizes, memory, excess, keep=MIN_RESULTS):
+    # Drops the lowest ranked results until excess bytes are released, always keeping the keep highest ranked ones
+    released = dropped = 0
+    while released < excess and len(results) > keep:
+        info_hash = min(results, key=lambda h: results[h].get_factor())
+        del results[info_hash]
+        provider, size = sizes[info_hash]
+        memory.remove(provider, "results", size)
+        released += size
+        dropped += 1
+    if dropped:
+        memory.degrade("dropping the lowest ranked results (%d kept)", len(results))
+
+
+def sort_results(results, get_setting):
     # noinspection PyTypeChecker
     return [
-        r.to_provider_result()
+        r.to_provider_data()
         for r in sorted(results.values(), key=Result.get_factor, reverse=True)
-        if include_result(r)
+        if include_result(r, get_setting)
     ]
 
 
+def get_search_results(search_type, data, scrapers, index=None, progress=True):
+    get_setting = CachedCall(get_boolean_setting)
+    scrapers = [s for s in scrapers if get_setting(s.id)]
+    if not scrapers:
+        logging.warning("No scrapers configured/enabled")
+        return None
+
+    indexed = None if index is None else []
+    memory = get_memory_account()
+    runner_class = ProgressScraperRunner if progress and get_setting("enable_bg_dialog") else ScraperRunner
+    with runner_class(scrapers, num_threads=get_int_setting("thread_number")) as runner:
+        # Results are merged one by one, as soon as any scraper produces them
+        if search_type == "query":
+            runner_data = runner.iter_parse_query(data, memory=memory)
+        else:
+            runner_data = runner.iter_parse(search_type, data, memory=memory)
+        results = merge_results(runner_data, indexed, memory=memory)
+    if memory is not None:
+        for row in memory.summary():
+            logging.debug("Memory of %s %s: %d allocations, %d bytes allocated, %d peak, %d retained", *row)
+        logging.debug("Search memory peak: %d bytes (%d retained)", memory.peak, memory.used)
+
+    if indexed:
+        from lib.index import search_key
+        index.update(search_key(search_type, data), indexed)
+
+    return sort_results(results, get_setting)
+
+
+def get_indexed_results(search_type, data, scrapers_getter, refresh):
+    # Indexed results are returned right away. When stale, they are refreshed in background by calling refresh
+    index = get_index()
+    if index is None:
+        return None, None
+    from lib.index import search_key
+    entry = index.get(search_key(search_type, data))
+    if entry is None:
+        return None, index
+
+    updated_at, indexed = entry
+    get_setting = CachedCall(get_boolean_setting)
+    scrapers = {s.id: s for s in scrapers_getter() if get_setting(s.id)}
+    results = merge_results((scrapers[provider], result) for provider, result in indexed if provider in scrapers)
+    if not results:
+        return None, index
+
+    if updated_at + get_int_setting("cache_ttl") * 60 < time.time():
+        logging.debug("Refreshing indexed results for %s search", search_type)
+        thread = threading.Thread(target=safe_call(None)(refresh), args=(search_type, data),
+                                  kwargs=dict(index=index, progress=False))
+        thread.daemon = True
+        thread.start()
+    logging.debug("Using %d indexed results for %s search", len(results), search_type)
+    return sort_results(results, get_setting), index
+
+
+def search_network(search_type, data, index=None, progress=True):
+    session = default_session(pool_size=get_int_setting("thread_number"), http2=get_boolean_setting("enable_http2"))
+    with session:
+        hedger = Hedger() if get_boolean_setting("enable_hedging") else None
+        concurrency = get_concurrency()
+        bandwidth = Bandwidth()
+        mirror_choices = MirrorChoices.load(MIRRORS_PATH)
+        scrapers = get_scrapers(session=session, cache=get_file_cache(), hedger=hedger, concurrency=concurrency,
+                                bandwidth=bandwidth, mirror_choices=mirror_choices)
+        warm_up([s for s in scrapers if get_boolean_setting(s.id)])
+        try:
+            return get_search_results(search_type, data, scrapers, index=index, progress=progress)
+        finally:
+            save_concurrency(concurrency)
+            save_mirror_choices(mirror_choices, scrapers)
+            log_bandwidth(bandwidth)
+
+
+def get_service_client():
+    # A search runs a few sequential requests per provider (pages and additional parsers), so the service is given a
+    # few provider timeouts before falling back to searching in process
+    from lib.service import ServiceClient
+    return ServiceClient(get_int_setting("service_port"), timeout=3 * get_int_setting("scraper_timeout"))
+
+
+def perform_search(search_type, data):
+    if get_boolean_setting("enable_service"):
+        # socket and socketserver are only imported when the service is enabled
+        from lib.service import ServiceError
+        try:
+            results = get_service_client().search(search_type, data)
+        except ServiceError as e:
+            logging.warning("Unable to search using the service, falling back to in-process search: %s", e)
+        else:
+            return None if results is None else [ProviderResult(**r) for r in results]
+
+    results, index = get_indexed_results(search_type, data, get_scrapers, search_network)
+    if results is None:
+        results = search_network(search_type, data, index=index)
+    return None if results is None else [ProviderResult(**r) for r in results]
+
+
+def prefetch_next(data):
+    searches = next_searches(data, next_episode=get_boolean_setting("prefetch_next_episode"),
+                             next_season=get_boolean_setting("prefetch_next_season"))
+    if not searches:
+        return
+
+    if get_boolean_setting("enable_service"):
+        from lib.service import ServiceError
+        try:
+            client = get_service_client()
+            for search_type, search_data in searches:
+                client.prefetch(search_type, search_data)
+            return
+        except ServiceError as e:
+            logging.warning("Unable to prefetch using the service, falling back to in-process prefetch: %s", e)
+
+    cache = get_file_cache()
+    if cache is None:
+        logging.debug("Cache is disabled, so there is no point on prefetching")
+        return
+
+    def run():
+        for search_type, search_data in searches:
+            try:
+                prefetch_search(search_type, search_data, cache)
+            except Exception as e:
+                logging.warning("Failed prefetching %s search: %s", search_type, e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
 class ProgressScraperRunner(ScraperRunner):
     def __init__(self, scrapers, num_threads=10):
         super(ProgressScraperRunner, self).__init__(scrapers, num_threads=num_threads)
@@ -191,8 +438,111 @@ class MagnetoProvider(Provider):
         return perform_search("season", dict(tmdb_id=tmdb_id, title=Title(show_title, titles), season=season_number))
 
     def search_episode(self, tmdb_id, show_title, season_number, episode_number, titles):
-        return perform_search("episode", dict(
-            tmdb_id=tmdb_id, title=Title(show_title, titles), season=season_number, episode=episode_number))
+        data = dict(tmdb_id=tmdb_id, title=Title(show_title, titles), season=season_number, episode=episode_number)
+        results = perform_search("episode", data)
+        prefetch_next(data)
+        return results
 
     def resolve(self, provider_data):
         raise NotImplementedError("Resolve method can't be called on this provider")
+
+
+class SearchService(object):
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+        self._scrapers = None
+        self._scrapers_key = None
+        self._cache = None
+        self._cache_ttl = None
+        # Kept across scrapers reloads, so the observed latencies are not lost
+        self._hedger = Hedger()
+        self._concurrency = None
+        # Counts the bytes transferred since the service started
+        self._bandwidth = Bandwidth()
+        self._mirror_choices = MirrorChoices.load(MIRRORS_PATH)
+        self._prefetcher = Prefetcher(self._prefetch)
+
+    def _get_scrapers(self):
+        # Providers are only reloaded when either the providers file or the relevant settings change
+        key = (os.path.getmtime(PROVIDERS_PATH), get_int_setting("scraper_timeout"), get_int_setting("cache_ttl"),
+               get_int_setting("thread_number"), get_boolean_setting("enable_hedging"),
+               get_boolean_setting("enable_http2"), get_boolean_setting("enable_adaptive_concurrency"))
+        with self._lock:
+            if self._scrapers_key != key:
+                old_key = self._scrapers_key or (None,) * len(key)
+                # The session is only recreated when the pool size or the protocol change
+                if (old_key[3], old_key[5]) != (key[3], key[5]):
+                    if self._session is not None:
+                        self._session.close()
+                    self._session = default_session(pool_size=key[3], http2=key[5])
+                if (old_key[3], old_key[6]) != (key[3], key[6]):
+                    save_concurrency(self._concurrency)
+                    self._concurrency = get_concurrency()
+                cache_ttl = key[2]
+                if cache_ttl != self._cache_ttl:
+                    self._cache = MemoryCache(cache_ttl * 60) if cache_ttl > 0 else None
+                    self._cache_ttl = cache_ttl
+                self._scrapers = get_scrapers(session=self._session, cache=self._cache,
+                                              hedger=self._hedger if key[4] else None, concurrency=self._concurrency,
+                                              bandwidth=self._bandwidth, mirror_choices=self._mirror_choices)
+                self._scrapers_key = key
+            return self._scrapers
+
+    def search(self, search_type, data):
+        logging.debug("Performing %s search on service", search_type)
+        # Providers with several mirrors choose one again (in background) once their choice is stale, as the service
+        # runs for longer than a choice lasts
+        warm_up([s for s in self._get_scrapers() if s.mirrors is not None and s.mirrors.stale and
+                 get_boolean_setting(s.id)])
+        with self._prefetcher.foreground():
+            results, index = get_indexed_results(search_type, data, self._get_scrapers, self._search_network)
+            if results is None:
+                results = self._search_network(search_type, data, index=index)
+            return results
+
+    def _search_network(self, search_type, data, index=None, progress=True):
+        scrapers = self._get_scrapers()
+        try:
+            return get_search_results(search_type, data, scrapers, index=index, progress=progress)
+        finally:
+            save_concurrency(self._concurrency)
+            save_mirror_choices(self._mirror_choices, scrapers)
+            log_bandwidth(self._bandwidth)
+
+    def prefetch(self, search_type, data):
+        self._prefetcher.submit(search_type, data)
+
+    def _prefetch(self, search_type, data):
+        self._get_scrapers()
+        if self._cache is None:
+            logging.debug("Cache is disabled, so there is no point on prefetching")
+        else:
+            prefetch_search(search_type, data, self._cache)
+
+    def close(self):
+        self._prefetcher.close()
+        save_concurrency(self._concurrency)
+        if self._session is not None:
+            self._session.close()
+
+
+def run_service():
+    if not get_boolean_setting("enable_service"):
+        logging.debug("Search service is disabled")
+        return
+
+    from lib.service import SearchServer
+    service = SearchService()
+    server = SearchServer(get_int_setting("service_port"), service.search, prefetch=service.prefetch)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    logging.info("Search service listening on port %s", server.server_address[1])
+
+    try:
+        Monitor().waitForAbort()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        service.close()
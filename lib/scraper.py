@@ -1,71 +1,350 @@
 import copy
+import functools
 import itertools
 import json
 import logging
 import re
-from concurrent.futures import ThreadPoolExecutor
-
-import requests
+import threading
+import time
+from collections import deque
+from contextlib import closing
 
+from lib import tracing
+from lib.filters import EPISODE, SEASON_PACK, match_episode
 from lib.formatter import ExtendedFormatter
-from lib.parsers import HTMLParser, JSONParser, XMLParser
+from lib.hedging import Cancelled
+from lib.limits import Limiter, RateLimited, parse_retry_after
+from lib.memory import sizeof_result
+from lib.mirrors import Mirrors
+from lib.offload import PARSERS, extract_from
+from lib.parsers import XMLStreamParser
+
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from urlparse import urljoin, urlparse
 
 try:
-    from urllib.parse import urljoin
+    from queue import Queue, Full
 except ImportError:
     # noinspection PyUnresolvedReferences
-    from urlparse import urljoin
+    from Queue import Queue, Full
 
 _formatter = ExtendedFormatter()
+_clock = getattr(time, "perf_counter", time.time)
+_chunk_size = 16 * 1024
 
 
-def default_session():
+_headers = {
+    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                   "AppleWebKit/537.36 (KHTML, like Gecko) "
+                   "Chrome/102.0.5005.63 Safari/537.36"),
+}
+
+
+def default_session(pool_size=None, http2=False):
+    if http2:
+        try:
+            from lib.http2 import Http2Session
+            return Http2Session(headers=_headers, pool_size=pool_size)
+        except (ImportError, SyntaxError) as e:
+            # httpx and h2 are optional (and python 3 only)
+            logging.debug("HTTP/2 is not available, using HTTP/1.1: %s", e)
+
+    import requests
     session = requests.Session()
-    session.headers = {
-        "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                       "AppleWebKit/537.36 (KHTML, like Gecko) "
-                       "Chrome/102.0.5005.63 Safari/537.36"),
-        "Accept-Encoding": "gzip",
-    }
+    # The default Accept-Encoding is kept, as it includes br and zstd when their decoders are installed
+    session.headers.update(_headers)
+    if pool_size is not None:
+        # Keep up to pool_size connections per host, so connections used concurrently are reused instead of discarded
+        from requests.adapters import HTTPAdapter
+        for prefix in ("http://", "https://"):
+            session.mount(prefix, HTTPAdapter(pool_maxsize=pool_size))
     return session
 
 
+class _ReleaseOnce(object):
+    # Releases the slots of a request once, either when it completes or when it is cancelled from another thread
+    def __init__(self, release):
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._release(*args, **kwargs)
+
+
+def _read(r, cancelled=None):
+    # Downloads the body a chunk at a time, so a cancelled request stops downloading and its connection is closed
+    chunks = []
+    for chunk in r.iter_content(_chunk_size):
+        if cancelled is not None and cancelled.is_set():
+            raise Cancelled("Download of {} was cancelled".format(r.url))
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _wire_size(r, size):
+    # The size of the body as received, before being decoded. Bodies are decoded a chunk at a time while downloaded
+    raw = getattr(r, "raw", None)
+    if raw is not None and hasattr(raw, "tell"):
+        return raw.tell()
+    return getattr(r, "num_bytes_downloaded", size)
+
+
+def _is_mirror_failure(e):
+    # Connection errors, timeouts and server errors, but neither client errors nor the provider limits
+    if isinstance(e, (Cancelled, RateLimited)):
+        return False
+    status_code = getattr(getattr(e, "response", None), "status_code", None)
+    return status_code is None or status_code >= 500
+
+
 class _BaseParser(object):
     # noinspection PyShadowingBuiltins
-    def __init__(self, url, data, base_url=None, type="html", mutate=(), session=None, timeout=None):
-        # type: (str, dict[str, str], str, str, list[dict[str, str]] | dict[str, str], requests.Session, int) -> None
+    def __init__(self, url, data, base_url=None, type="html", mutate=(), session=None, timeout=None, parse_pool=None,
+                 hedger=None, limiter=None, concurrency=None, bandwidth=None):
+        # type: (str, dict, str, str, list | dict, Session, int, ParsePool, Hedger, Limiter, Concurrency,
+        #       Bandwidth) -> None
         self._url = url
         self._data = data
-        self._base_url = base_url
+        # The base url is either fixed or the current one of the provider mirrors
+        self._mirrors = base_url if isinstance(base_url, Mirrors) else None
+        self._fixed_base_url = None if self._mirrors is not None else base_url
         self._mutate = list(mutate.items()) if isinstance(mutate, dict) else [i for m in mutate for i in m.items()]
-        self._session = session or requests
+        self._session = session
         self._timeout = timeout
+        self._parse_pool = parse_pool
+        self._hedger = hedger
+        self._limiter = limiter
+        self._concurrency = concurrency
+        self._bandwidth = bandwidth
 
-        if type == "html":
-            self._clazz = HTMLParser
-        elif type == "json":
-            self._clazz = JSONParser
-        elif type == "xml":
-            self._clazz = XMLParser
-        else:
-            raise ValueError("type must be one of html/json/xml")
+        if type not in PARSERS:
+            raise ValueError("type must be one of html/json/xml/regex")
+        self._type = type
 
     def _mutate_result(self, result):
         for key, value in self._mutate:
             result[key] = _formatter.format(value, **result)
 
+    def _mutate_results(self, results):
+        if self._mutate:
+            with tracing.span("mutate", rows=len(results)):
+                for result in results:
+                    self._mutate_result(result)
+
+    @property
+    def _base_url(self):
+        return self._fixed_base_url if self._mirrors is None else self._mirrors.current
+
+    @property
+    def mirrors(self):
+        return self._mirrors
+
+    @property
+    def host(self):
+        url = urlparse(self._base_url)
+        return url.scheme, url.netloc
+
+    def warm_up(self):
+        # Performs DNS resolution and the TCP/TLS handshakes, leaving the connection in the session pool
+        if self._session is None:
+            return
+        host = self._acquire(self._base_url)
+        try:
+            if self._mirrors is not None and self._mirrors.stale:
+                # Probing the mirrors also opens a connection to each of them
+                logging.debug("Probing mirrors %s", ", ".join(self._mirrors.urls))
+                with tracing.span("probe"):
+                    self._mirrors.probe(self._session, timeout=self._timeout)
+                return
+            logging.debug("Warming up connection to %s", self._base_url)
+            with tracing.span("warm_up", url=self._base_url):
+                with closing(self._session.head(self._base_url, timeout=self._timeout, allow_redirects=False)):
+                    pass
+        finally:
+            self._release(host)
+
     def _get_url_formatted(self, **kwargs):
         return _formatter.format(self._url, **kwargs)
 
     def _get_full_url(self, url):
         return urljoin(self._base_url, url)
 
+    def _failover(self, func, url):
+        # Requests which fail on a mirror are sent to the next healthy one, each mirror being tried at most once
+        if self._mirrors is None:
+            return func(url)
+        url = self._mirrors.redirect(url)
+        tried = []
+        while True:
+            try:
+                return func(url)
+            except Exception as e:
+                mirror = self._mirrors.mirror_of(url)
+                if mirror is None or not _is_mirror_failure(e):
+                    raise
+                tried.append(mirror)
+                mirror = self._mirrors.fail(url, excluded=tried)
+                if mirror is None:
+                    raise
+                logging.debug("Retrying %s on mirror %s: %s", url, mirror, e)
+                url = self._mirrors.rebase(url, mirror)
+
     def _get_content(self, url):
         # type: (str) -> (str, bytes)
+        return self._failover(self._get_hedged_content, url)
+
+    def _get_hedged_content(self, url):
         logging.debug("Getting content for url %s", url)
-        r = self._session.get(url, timeout=self._timeout)
-        r.raise_for_status()
-        return r.url, r.content
+        if self._hedger is None:
+            return self._fetch(url)
+        # Latencies are tracked per provider and parser, as results and detail pages may take very different times
+        return self._hedger.call((self.host, self._url), tracing.bind(lambda cancelled: self._fetch(url, cancelled)))
+
+    def _acquire(self, url):
+        # Returns the host the concurrency slot was taken on, which must be the one released, even if the request
+        # moved to another mirror meanwhile
+        url = urlparse(url)
+        host = "{}://{}".format(url.scheme, url.netloc)
+        if self._limiter is not None:
+            with tracing.span("limit"):
+                self._limiter.acquire(self._timeout)
+        if self._concurrency is not None:
+            try:
+                with tracing.span("concurrency"):
+                    self._concurrency.acquire(host, self._timeout)
+            except Exception:
+                if self._limiter is not None:
+                    self._limiter.release()
+                raise
+        return host
+
+    def _release(self, host, start=None, latency=None, overloaded=False, failed=False):
+        if self._concurrency is not None:
+            self._concurrency.release(host, start, latency, overloaded=overloaded, failed=failed)
+        if self._limiter is not None:
+            self._limiter.release()
+
+    def _should_retry(self, r, attempt, host):
+        if r.status_code not in (429, 503):
+            return False
+        if self._limiter is not None:
+            if attempt >= self._limiter.retries:
+                return False
+            delay = self._limiter.backoff(attempt, parse_retry_after(r.headers.get("Retry-After")))
+            logging.debug("Got status %d from %s, retrying in %.1fs", r.status_code, r.url, delay)
+            return True
+        if self._concurrency is not None and attempt < self._concurrency.retries:
+            # The provider concurrency is also decreased when the request is released, so the retry waits for both
+            delay = self._concurrency.backoff(host, attempt, parse_retry_after(r.headers.get("Retry-After")))
+            logging.debug("Got status %d from %s, retrying in %.1fs with a lower concurrency", r.status_code, r.url,
+                          delay)
+            return True
+        return False
+
+    def _send(self, url):
+        with tracing.span("request", url=url) as span:
+            if self._session is None:
+                import requests
+                r = requests.get(url, timeout=self._timeout, stream=True)
+            else:
+                r = self._session.get(url, timeout=self._timeout, stream=True)
+            span.set(status=r.status_code)
+        return r
+
+    def _open(self, url):
+        # Returns the response as soon as its headers are received, so its body can be streamed. The provider limits
+        # only cover the request, as the body is read while the rows are processed (which may request the provider)
+        attempt = 0
+        while True:
+            host = self._acquire(url)
+            start = _clock()
+            status_code = latency = None
+            try:
+                r = self._send(url)
+                status_code = r.status_code
+                if self._should_retry(r, attempt, host):
+                    r.close()
+                    attempt += 1
+                    continue
+                try:
+                    r.raise_for_status()
+                except Exception:
+                    r.close()
+                    raise
+                latency = _clock() - start
+                return r
+            finally:
+                self._release(host, start, latency, overloaded=status_code in (429, 503), failed=status_code is None)
+
+    def _fetch(self, url, cancelled=None):
+        attempt = 0
+        while True:
+            host = self._acquire(url)
+            start = _clock()
+            status_code = latency = None
+            release = _ReleaseOnce(self._release)
+            if cancelled is not None:
+                # A losing hedged request gives back its slots as soon as the other one wins, instead of holding them
+                # until its response arrives. It is neither a success nor a failure, so the limits are not adapted
+                cancelled.add_callback(lambda: release(host))
+            try:
+                if cancelled is not None and cancelled.is_set():
+                    raise Cancelled("Request to {} was cancelled".format(url))
+                r = self._send(url)
+                status_code = r.status_code
+
+                with closing(r):
+                    if cancelled is not None and cancelled.is_set():
+                        raise Cancelled("Request to {} was cancelled".format(url))
+                    if self._should_retry(r, attempt, host):
+                        attempt += 1
+                        continue
+                    r.raise_for_status()
+                    with tracing.span("download", url=url) as span:
+                        download_start = _clock()
+                        content = _read(r, cancelled)
+                        wire_size = _wire_size(r, len(content))
+                        span.set(size=len(content), wire_size=wire_size)
+                    latency = _clock() - start
+                    if self._bandwidth is not None:
+                        self._bandwidth.add(wire_size, len(content), start + latency - download_start)
+                return r.url, content
+            finally:
+                # Requests which failed to get a response (timeouts, connection errors) or were throttled reduce the
+                # provider concurrency
+                release(host, start, latency, overloaded=status_code in (429, 503), failed=status_code is None)
+
+    def _extract(self, content, rows, next_page_xpath=None, memory=None):
+        if memory is not None:
+            memory.add("body", len(content))
+        try:
+            # Big pages are parsed in the parse pool (if any), so parsing does not hold the GIL of the search threads
+            if self._parse_pool is not None and self._parse_pool.accepts(content):
+                with tracing.span("parse", type=self._type, size=len(content), offloaded=True):
+                    return self._parse_pool.extract(self._type, content, rows, self._data, next_page_xpath)
+            with tracing.span("parse", type=self._type, size=len(content)):
+                parser = PARSERS[self._type](content)
+            with tracing.span("extract"):
+                values = extract_from(parser, rows, self._data, next_page_xpath)
+            if memory is not None:
+                # The parsed document is released right away, so it only counts towards the peak
+                usage = parser.memory_usage()
+                for stage, size in usage.items():
+                    memory.add(stage, size)
+                for stage, size in usage.items():
+                    memory.remove(stage, size)
+            return values
+        finally:
+            if memory is not None:
+                memory.remove("body", len(content))
 
 
 class AdditionalParser(_BaseParser):
@@ -74,87 +353,151 @@ class AdditionalParser(_BaseParser):
         super(AdditionalParser, self).__init__(url, data, **kwargs)
         self._rows = rows
 
-    def _update_result(self, result, content):
-        self._clazz(content).update_result(self._data, result)
-        self._mutate_result(result)
-        yield result
+    def _update_result(self, result, content, memory=None):
+        values, _ = self._extract(content, None, memory=memory)
+        result.update(values)
+        return [result]
 
-    def _get_additional_results_and_update(self, result, content):
-        for new_result in self._clazz(content).parse_results(self._rows, self._data):
+    def _get_additional_results_and_update(self, result, content, memory=None):
+        new_results, _ = self._extract(content, self._rows, memory=memory)
+
+        results = []
+        for new_result in new_results:
             updated_result = copy.copy(result)
             updated_result.update(new_result)
-            self._mutate_result(updated_result)
-            yield updated_result
+            results.append(updated_result)
+        return results
 
-    def get_and_update_result(self, result):
-        _, content = self._get_content(self._get_full_url(self._get_url_formatted(**result)))
+    def get_and_update_result(self, result, memory=None):
+        with tracing.span("additional"):
+            _, content = self._get_content(self._get_full_url(self._get_url_formatted(**result)))
 
-        if self._rows is None:
-            results = self._update_result(result, content)
-        else:
-            results = self._get_additional_results_and_update(result, content)
+            if self._rows is None:
+                results = self._update_result(result, content, memory=memory)
+            else:
+                results = self._get_additional_results_and_update(result, content, memory=memory)
 
-        return list(results)
+            self._mutate_results(results)
+            return results
 
 
 class ResultsParser(_BaseParser):
-    def __init__(self, url, data, rows, total_pages=1, next_page_url_type="xpath", next_page_url=None, **kwargs):
-        # type: (str, dict[str, str], str, int, str, str, any) -> None
+    def __init__(self, url, data, rows, total_pages=1, next_page_url_type="xpath", next_page_url=None, stream=False,
+                 **kwargs):
+        # type: (str, dict[str, str], str, int, str, str, bool, any) -> None
         super(ResultsParser, self).__init__(url, data, **kwargs)
         self._rows = rows
+        self._next_page_xpath = None
+
+        if stream and self._type != "xml":
+            raise ValueError("stream is only supported by xml parsers")
+        self._stream = stream
 
         if total_pages is None or total_pages <= 1 or next_page_url is None:
             self._total_pages = 1
-            self._next_page_cb = lambda parser, **kw: None
+            self._next_page_cb = lambda element, **kw: None
         else:
             self._total_pages = total_pages
             if next_page_url_type == "static":
-                self._next_page_cb = lambda parser, page=1, **kw: _formatter.format(next_page_url, page=page + 1, **kw)
+                self._next_page_cb = lambda element, page=1, **kw: _formatter.format(next_page_url, page=page + 1, **kw)
             elif next_page_url_type == "xpath":
-                self._next_page_cb = lambda parser, **kw: parser.try_get_element(next_page_url)
+                self._next_page_xpath = next_page_url
+                self._next_page_cb = lambda element, **kw: element
             else:
                 raise ValueError("next_page_url_type must be one of static/xpath")
 
-    def _get_and_parse_results(self, url, **kwargs):
+    def _get_and_parse_results(self, url, memory=None, **kwargs):
         real_url, content = self._get_content(url)
-        parser = self._clazz(content)
-        results = parser.parse_results(self._rows, self._data)
-        for result in results:
-            self._mutate_result(result)
-        return results, real_url, self._next_page_cb(parser, **kwargs)
+        results, next_page_element = self._extract(
+            content, self._rows, next_page_xpath=self._next_page_xpath, memory=memory)
+        self._mutate_results(results)
+        return results, real_url, self._next_page_cb(next_page_element, **kwargs)
+
+    def _stream_results(self, url, page_info, **kwargs):
+        # Yields the results while the page is downloaded, and then sets its url and next page on page_info
+        with closing(self._failover(self._open, url)) as r, tracing.span("stream", url=url) as span:
+            start = _clock()
+            size = [0]
+
+            def chunks():
+                for chunk in r.iter_content(_chunk_size):
+                    size[0] += len(chunk)
+                    yield chunk
+
+            parser = XMLStreamParser(chunks())
+            for result in parser.iter_results(self._rows, self._data):
+                self._mutate_result(result)
+                yield result
+
+            next_page_element = None
+            if self._next_page_xpath is not None:
+                next_page_element = parser.try_get_element(self._next_page_xpath)
+            span.set(size=size[0])
+            if self._bandwidth is not None:
+                self._bandwidth.add(_wire_size(r, size[0]), size[0], _clock() - start)
+            page_info.update(url=r.url, next_page=self._next_page_cb(next_page_element, **kwargs))
+
+    def _iter_page_results(self, url, page_info, memory=None, **kwargs):
+        if self._stream:
+            return self._stream_results(url, page_info, **kwargs)
+        results, page_info["url"], page_info["next_page"] = self._get_and_parse_results(url, memory=memory, **kwargs)
+        return results
 
-    def get_and_parse_results(self, query):
+    def get_and_parse_results(self, query, memory=None):
+        return list(self.iter_results(query, memory=memory))
+
+    def iter_results(self, query, memory=None):
+        # Yields the results of each page as soon as it is parsed, so they are processed while the next page is fetched
         url = self._get_full_url(self._get_url_formatted(query=query))
-        results, base_url, next_page = self._get_and_parse_results(url, query=query)
+        page_info = {}
+        for result in self._iter_page_results(url, page_info, memory=memory, query=query):
+            yield result
+        base_url, next_page = page_info["url"], page_info["next_page"]
 
         # Handle next pages, if any
         if next_page is not None:
             visited_urls = [base_url]
 
             for page in range(2, self._total_pages + 1):
+                if memory is not None and memory.exceeded:
+                    memory.degrade("skipping the remaining pages")
+                    break
                 new_page_url = urljoin(base_url, next_page)
                 # Check for recursive calls
                 if new_page_url in visited_urls:
                     logging.warning("Detected an already visited URL: %s", new_page_url)
                     break
 
-                new_results, base_url, next_page = self._get_and_parse_results(new_page_url, page=page, query=query)
-                if len(new_results) == 0:
+                page_info = {}
+                count = 0
+                for result in self._iter_page_results(new_page_url, page_info, memory=memory, page=page, query=query):
+                    count += 1
+                    yield result
+                if count == 0:
                     break
 
-                results.extend(new_results)
+                base_url, next_page = page_info["url"], page_info["next_page"]
                 if next_page is None:
                     break
 
                 visited_urls.append(new_page_url)
 
-        return results
-
 
-def _run(pool, func, iterable):
+def _iter_run(pool, func, iterable, buffer_size=32):
+    # Same as map, but it does not consume the whole iterable upfront. At most buffer_size calls are pending at once,
+    # and the results are yielded in order, as soon as they are available
     if pool is None:
-        return [func(data) for data in iterable]
-    return list(pool.map(func, iterable))
+        for data in iterable:
+            yield func(data)
+        return
+
+    pending = deque()
+    for data in iterable:
+        pending.append(pool.submit(func, data))
+        if len(pending) >= buffer_size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def safe_call(on_failure):
@@ -171,30 +514,57 @@ def safe_call(on_failure):
     return decorator
 
 
+def warm_up(scrapers):
+    # Opens a connection to each scraper host in background, so the searches do not have to wait for it
+    hosts = set()
+    for scraper in scrapers:
+        if scraper.host not in hosts:
+            hosts.add(scraper.host)
+            thread = threading.Thread(target=safe_call(None)(scraper.warm_up))
+            thread.daemon = True
+            thread.start()
+
+
 class Scraper(object):
     _spaces_re = re.compile(r"\s+")
+    # The minimum number of episode (not season pack) results required to answer an episode search from the cache
+    min_cached_episode_results = 1
+    # The maximum number of rows waiting to be processed by each additional parser
+    buffer_size = 32
 
     @classmethod
-    def get_scrapers(cls, path, timeout=None, session=None):
+    def get_scrapers(cls, path, timeout=None, session=None, cache=None, parse_pool=None, hedger=None,
+                     concurrency=None, bandwidth=None, mirror_choices=None):
         with open(path) as f:
-            return [cls.from_data(data, timeout=timeout, session=session) for data in json.load(f)]
+            return [cls.from_data(data, timeout=timeout, session=session, cache=cache, parse_pool=parse_pool,
+                                  hedger=hedger, concurrency=concurrency, bandwidth=bandwidth,
+                                  mirror_choices=mirror_choices) for data in json.load(f)]
 
     @classmethod
-    def from_data(cls, data, timeout=None, session=None):
+    def from_data(cls, data, timeout=None, session=None, cache=None, parse_pool=None, hedger=None, concurrency=None,
+                  bandwidth=None, mirror_choices=None):
+        # All parsers of a provider share the same limits and mirrors, as they all request the same host
+        limits = data.get("limits")
         base_url = data["base_url"]
+        if isinstance(base_url, list):
+            current, chosen_at = (None, None) if mirror_choices is None else mirror_choices.get(data["name"])
+            base_url = Mirrors(base_url, current=current, chosen_at=chosen_at)
+        kwargs = dict(base_url=base_url, session=session, timeout=timeout, parse_pool=parse_pool,
+                      hedger=hedger, limiter=None if limits is None else Limiter(**limits), concurrency=concurrency,
+                      bandwidth=None if bandwidth is None else bandwidth.scope(data["name"]))
         return cls(
-            data["name"], ResultsParser(base_url=base_url, session=session, timeout=timeout, **data["results_parser"]),
-            additional_parsers=[AdditionalParser(base_url=base_url, session=session, timeout=timeout, **d)
-                                for d in data.get("additional_parsers", [])],
-            keywords=data.get("keywords"), attributes=data.get("attributes"))
+            data["name"], ResultsParser(**dict(kwargs, **data["results_parser"])),
+            additional_parsers=[AdditionalParser(**dict(kwargs, **d)) for d in data.get("additional_parsers", [])],
+            keywords=data.get("keywords"), attributes=data.get("attributes"), cache=cache)
 
-    def __init__(self, name, results_parser, additional_parsers=None, keywords=None, attributes=None):
-        # type: (str, ResultsParser, list[AdditionalParser], dict[str, str], dict) -> None
+    def __init__(self, name, results_parser, additional_parsers=None, keywords=None, attributes=None, cache=None):
+        # type: (str, ResultsParser, list[AdditionalParser], dict[str, str], dict, MemoryCache) -> None
         self._name = name
         self._results_parser = results_parser
         self._additional_parsers = additional_parsers or []
         self._keywords = keywords or {}
         self._attributes = attributes or {}
+        self._cache = cache
 
     @property
     def name(self):
@@ -204,6 +574,18 @@ class Scraper(object):
     def id(self):
         return self._spaces_re.sub(".", self._name.lower())
 
+    @property
+    def host(self):
+        return self._results_parser.host
+
+    @property
+    def mirrors(self):
+        return self._results_parser.mirrors
+
+    def warm_up(self):
+        with tracing.context(provider=self._name):
+            self._results_parser.warm_up()
+
     def get_attribute(self, key, **kwargs):
         sentinel = object()
         attribute = self._attributes.get(key, sentinel)
@@ -218,27 +600,135 @@ class Scraper(object):
         query = _formatter.format(self._keywords[keyword], **formats)
         return self._spaces_re.sub(" ", query.strip())
 
-    def parse(self, keyword, formats, ignore_failed_updates=True, pool=None):
-        return self.parse_query(
-            self._format_query(keyword, formats), ignore_failed_updates=ignore_failed_updates, pool=pool)
+    def parse(self, keyword, formats, ignore_failed_updates=True, pool=None, memory=None):
+        return list(self.iter_parse(
+            keyword, formats, ignore_failed_updates=ignore_failed_updates, pool=pool, memory=memory))
+
+    def iter_parse(self, keyword, formats, ignore_failed_updates=True, pool=None, memory=None):
+        if keyword == "episode":
+            results = self._get_episode_results_from_season(formats)
+            if results is not None:
+                return iter(results)
+
+        return self.iter_query(
+            self._format_query(keyword, formats), ignore_failed_updates=ignore_failed_updates, pool=pool, memory=memory)
+
+    def _get_episode_results_from_season(self, formats):
+        # Season results usually contain the individual episodes, as well as the season packs
+        if self._cache is None or "season" not in self._keywords:
+            return None
+        season_results = self._cache.get(self._cache_key(self._format_query("season", formats)))
+        if season_results is None:
+            return None
+
+        season, episode = int(formats["season"]), int(formats["episode"])
+        results, episodes_count = [], 0
+        for result in season_results:
+            match = match_episode(result["title"], season, episode)
+            if match == EPISODE:
+                episodes_count += 1
+            if match in (EPISODE, SEASON_PACK):
+                results.append(dict(result))
+
+        if episodes_count < self.min_cached_episode_results:
+            logging.debug("Not enough cached %s season results for S%02dE%02d", self._name, season, episode)
+            return None
+
+        logging.debug("Using %d cached %s season results for S%02dE%02d", len(results), self._name, season, episode)
+        return results
 
-    def parse_query(self, query, ignore_failed_updates=True, pool=None):
+    def _iter_query(self, query, ignore_failed_updates=True, pool=None, memory=None):
         decorator = safe_call(()) if ignore_failed_updates else lambda x: x
-        results = self._results_parser.get_and_parse_results(query)
+        results = self._results_parser.iter_results(query, memory=memory)
 
+        # Each additional parser is a stage which starts processing rows as soon as the previous stage yields them
         for parser in self._additional_parsers:
-            results = list(itertools.chain(*_run(pool, decorator(parser.get_and_update_result), results)))
+            func = tracing.bind(decorator(parser.get_and_update_result))
+            if memory is not None:
+                func = functools.partial(func, memory=memory)
+            results = (r for updated_results in _iter_run(pool, func, results, self.buffer_size)
+                       for r in updated_results)
+
+        return results
 
-        if len(results) == 0:
+    def _cache_key(self, query):
+        return "{}:{}".format(self.id, query)
+
+    def parse_query(self, query, ignore_failed_updates=True, pool=None, memory=None):
+        return list(self.iter_query(query, ignore_failed_updates=ignore_failed_updates, pool=pool, memory=memory))
+
+    def iter_query(self, query, ignore_failed_updates=True, pool=None, memory=None):
+        if self._cache is not None:
+            results = self._cache.get(self._cache_key(query))
+            if results is not None:
+                logging.debug("Using cached %s results for query: %s", self._name, query)
+                for result in results:
+                    yield dict(result)
+                return
+
+        with tracing.context(provider=self._name):
+            span = tracing.span("scraper", query=query)
+            if memory is not None:
+                memory = memory.scope(self._name)
+            results = self._iter_query(query, ignore_failed_updates=ignore_failed_updates, pool=pool, memory=memory)
+            # The pipeline runs while the results are consumed, so each step must run within the provider context
+            next_result = tracing.bind(lambda: next(results, None))
+
+        cached_results = [] if self._cache is not None else None
+        cached_size = count = 0
+        with span:
+            result = next_result()
+            while result is not None:
+                count += 1
+                if memory is not None:
+                    if cached_results is not None and memory.degraded:
+                        # Degraded results are not cached, so the rows kept so far are released
+                        cached_results = None
+                        memory.remove("rows", cached_size)
+                        cached_size = 0
+                    # Rows are only held by the search until they are cached, the merged results are accounted apart
+                    size = sizeof_result(result)
+                    memory.add("rows", size)
+                    if cached_results is None:
+                        memory.remove("rows", size)
+                    else:
+                        cached_size += size
+                if cached_results is not None:
+                    cached_results.append(dict(result))
+                yield result
+                result = next_result()
+
+        if count == 0:
             logging.warning("No results found for query: %s", query)
+        elif memory is not None and memory.degraded:
+            logging.debug("Not caching the %s results, as the search was degraded", self._name)
+        elif cached_results is not None:
+            self._cache.set(self._cache_key(query), cached_results)
+        if cached_size:
+            memory.remove("rows", cached_size)
 
-        return results
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
 
 
 class ScraperRunner(object):
-    def __init__(self, scrapers, num_threads=10):
+    def __init__(self, scrapers, num_threads=10, buffer_size=256):
+        from concurrent.futures import ThreadPoolExecutor
         self._scrapers = scrapers
         self._pool = ThreadPoolExecutor(num_threads)
+        # Scrapers wait for their additional parsers, so these run on their own pool. Otherwise, the scrapers could
+        # take all the threads, leaving none for the parsers they wait for. A scraper keeps requesting pages while its
+        # parsers run, so the pool has a thread less, which keeps the requests to a provider within num_threads
+        self._parsers_pool = ThreadPoolExecutor(max(1, num_threads - 1))
+        self._num_threads = num_threads
+        self._buffer_size = buffer_size
 
     def parse(self, *args, **kwargs):
         return self._run_scrapers(Scraper.parse, *args, **kwargs)
@@ -246,13 +736,83 @@ class ScraperRunner(object):
     def parse_query(self, *args, **kwargs):
         return self._run_scrapers(Scraper.parse_query, *args, **kwargs)
 
+    def iter_parse(self, *args, **kwargs):
+        return self._stream_scrapers(Scraper.iter_parse, *args, **kwargs)
+
+    def iter_parse_query(self, *args, **kwargs):
+        return self._stream_scrapers(Scraper.iter_query, *args, **kwargs)
+
+    def _stream_scrapers(self, method, *args, **kwargs):
+        # Yields (scraper, result) pairs as soon as any scraper produces them. Scrapers are paused when more than
+        # buffer_size results are waiting to be consumed
+        queue = Queue(self._buffer_size)
+        stop = threading.Event()
+        done = object()
+
+        def run(scraper):
+            try:
+                for result in method(scraper, *args, pool=self._parsers_pool, **kwargs):
+                    if not _put(queue, (scraper, result), stop):
+                        return
+            except Exception as e:
+                logging.error("Failed running scraper %s: %s", scraper.name, e)
+            _put(queue, (scraper, done), stop)
+
+        for s in self._scrapers:
+            self._pool.submit(run, s)
+
+        remaining = len(self._scrapers)
+        try:
+            while remaining:
+                scraper, result = queue.get()
+                if result is done:
+                    self.before_result(scraper)
+                    remaining -= 1
+                else:
+                    yield scraper, result
+        finally:
+            stop.set()
+
+    def _parse_job(self, scraper, job, **kwargs):
+        keyword, formats = job
+        if keyword == "query":
+            return scraper.parse_query(formats, pool=self._parsers_pool, **kwargs)
+        return scraper.parse(keyword, formats, pool=self._parsers_pool, **kwargs)
+
+    def parse_many(self, jobs, **kwargs):
+        # Runs many (keyword, formats) jobs at once (formats being the query string on "query" jobs), yielding
+        # (job, scraper, results) as soon as each scraper finishes each job
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        tasks = ((job, scraper) for job in jobs for scraper in self._scrapers)
+        # The additional parsers run on their own pool, so every thread can run a scraper
+        pending = {}
+
+        while True:
+            for job, scraper in itertools.islice(tasks, self._num_threads - len(pending)):
+                pending[self._pool.submit(self._parse_job, scraper, job, **kwargs)] = (job, scraper)
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, scraper = pending.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logging.error("Failed running scraper %s for %s job: %s", scraper.name, job[0], e)
+                else:
+                    yield job, scraper, results
+
     def _run_scrapers(self, method, *args, **kwargs):
-        results = [(scraper, self._pool.submit(method, scraper, *args, pool=self._pool, **kwargs))
+        results = [(scraper, self._pool.submit(method, scraper, *args, pool=self._parsers_pool, **kwargs))
                    for scraper in self._scrapers]
         for scraper, scraper_results in results:
             try:
                 self.before_result(scraper)
-                yield scraper, scraper_results.result()
+                with tracing.span("wait", provider=scraper.name):
+                    scraper_results = scraper_results.result()
+                yield scraper, scraper_results
             except Exception as e:
                 logging.error("Failed running scraper %s: %s", scraper.name, e)
 
@@ -261,6 +821,7 @@ class ScraperRunner(object):
 
     def close(self):
         self._pool.shutdown()
+        self._parsers_pool.shutdown()
 
     def __enter__(self):
         return self
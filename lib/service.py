@@ -0,0 +1,116 @@
+import json
+import logging
+import socket
+from contextlib import closing
+
+try:
+    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+except ImportError:
+    # noinspection PyUnresolvedReferences
+    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+from lib.utils import Title, text
+
+LOCALHOST = "127.0.0.1"
+
+
+class ServiceError(Exception):
+    pass
+
+
+# noinspection PyProtectedMember
+def encode_data(data):
+    if isinstance(data, Title):
+        return {"__title__": text(data), "titles": data._titles}
+    if isinstance(data, dict):
+        return {k: encode_data(v) for k, v in data.items()}
+    return data
+
+
+def decode_data(data):
+    if isinstance(data, dict):
+        if "__title__" in data:
+            return Title(data["__title__"], data["titles"])
+        return {k: decode_data(v) for k, v in data.items()}
+    return data
+
+
+class _SearchRequestHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            if request.get("prefetch"):
+                self.server.prefetch(request["search_type"], decode_data(request["data"]))
+                response = dict(results=None)
+            else:
+                response = dict(results=self.server.search(request["search_type"], decode_data(request["data"])))
+        except Exception as e:
+            logging.error("Failed handling service request: %s", e)
+            response = dict(error=str(e))
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class SearchServer(ThreadingMixIn, TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, search, prefetch=None, host=LOCALHOST):
+        # type: (int, callable, callable, str) -> None
+        TCPServer.__init__(self, (host, port), _SearchRequestHandler)
+        self.search = search
+        self._prefetch = prefetch
+
+    def prefetch(self, search_type, data):
+        if self._prefetch is None:
+            raise ValueError("Prefetching is not supported")
+        self._prefetch(search_type, data)
+
+
+class ServiceClient(object):
+    # The fields of each result returned by the service (see Result.to_provider_data)
+    result_fields = frozenset(("label", "label2", "icon", "url"))
+
+    def __init__(self, port, host=LOCALHOST, connect_timeout=1, timeout=None):
+        # type: (int, str, float, float) -> None
+        self._address = (host, port)
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+
+    def search(self, search_type, data):
+        results = self._request(dict(search_type=search_type, data=encode_data(data)))
+        # Another server may be listening on the port, so results which can't be shown are not trusted
+        if results is not None and not (isinstance(results, list) and all(
+                isinstance(r, dict) and set(r) == self.result_fields for r in results)):
+            raise ServiceError("Service returned unexpected results")
+        return results
+
+    def prefetch(self, search_type, data):
+        self._request(dict(search_type=search_type, data=encode_data(data), prefetch=True))
+
+    def _request(self, request):
+        try:
+            sock = socket.create_connection(self._address, timeout=self._connect_timeout)
+        except socket.error as e:
+            raise ServiceError("Service is not running: {}".format(e))
+
+        try:
+            sock.settimeout(self._timeout)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with closing(sock.makefile("rb")) as f:
+                line = f.readline()
+        except socket.error as e:
+            raise ServiceError("Failed communicating with service: {}".format(e))
+        finally:
+            sock.close()
+
+        if not line:
+            raise ServiceError("Service closed the connection")
+        try:
+            response = json.loads(line.decode("utf-8"))
+        except ValueError as e:
+            raise ServiceError("Service returned an invalid response: {}".format(e))
+        if not isinstance(response, dict):
+            raise ServiceError("Service returned an unexpected response")
+        if "error" in response:
+            raise ServiceError(response["error"])
+        return response.get("results")
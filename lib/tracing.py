@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+_clock = getattr(time, "perf_counter", time.time)
+_tracer = None
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **kwargs):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ("_tracer", "name", "args", "thread", "start", "end")
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self.name = name
+        self.args = args
+        self.thread = None
+        self.start = self.end = None
+
+    def set(self, **kwargs):
+        self.args.update(kwargs)
+
+    def __enter__(self):
+        self.thread = threading.current_thread().ident
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = _clock()
+        if exc_type is not None:
+            self.args["error"] = str(exc_val)
+        self._tracer.add(self)
+        return False
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class _Context(object):
+    def __init__(self, local, context):
+        self._local = local
+        self._context = context
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = getattr(self._local, "context", None)
+        self._local.context = self._context
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._local.context = self._previous
+        return False
+
+
+class Tracer(object):
+    def __init__(self):
+        self._spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = _clock()
+
+    @property
+    def spans(self):
+        return list(self._spans)
+
+    def add(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def current_context(self):
+        return getattr(self._local, "context", None) or {}
+
+    def span(self, name, args):
+        for key, value in self.current_context().items():
+            args.setdefault(key, value)
+        return Span(self, name, args)
+
+    def context(self, **context):
+        return _Context(self._local, dict(self.current_context(), **context))
+
+    def bind(self, func):
+        context = self.current_context()
+
+        def wrapper(*args, **kwargs):
+            with _Context(self._local, context):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        return {"displayTimeUnit": "ms", "traceEvents": [
+            {"name": s.name, "cat": s.args.get("provider", "magneto"), "ph": "X", "pid": pid, "tid": s.thread,
+             "ts": (s.start - self._origin) * 1e6, "dur": s.duration * 1e6, "args": s.args}
+            for s in self.spans]}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+
+    def summary(self):
+        stages = defaultdict(list)
+        for s in self.spans:
+            stages[(s.args.get("provider", ""), s.name)].append(s.duration)
+        return sorted(((provider, name, len(d), sum(d), max(d)) for (provider, name), d in stages.items()),
+                      key=lambda row: (row[0], -row[3]))
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def span(name, **args):
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, args)
+
+
+def context(**kwargs):
+    if _tracer is None:
+        return _null_span
+    return _tracer.context(**kwargs)
+
+
+def bind(func):
+    if _tracer is None:
+        return func
+    return _tracer.bind(func)
@@ -6,15 +6,24 @@ import logging
 import os
 import re
 import sys
-from contextlib import closing
+from contextlib import ExitStack, closing, contextmanager
 
 import jsonschema
 import requests
 from defusedxml import ElementTree, minidom
 
+from lib import tracing
+from lib.archive import Archive, mount_archive
+from lib.bandwidth import Bandwidth
+from lib.cache import MemoryCache
 from lib.filters import Resolution, ReleaseType
-from lib.parsers import XMLParser, JSONParser, HTMLParser, create_xml_tree
+from lib.formatter import sizeof_fmt
+from lib.hedging import Hedger
+from lib.memory import MemoryAccount
+from lib.offload import ParsePool
+from lib.parsers import XMLParser, JSONParser, HTMLParser, RegexParser, create_xml_tree
 from lib.scraper import Scraper, ScraperRunner, default_session
+from lib.service import SearchServer
 
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 RESOURCES_PATH = os.path.join(ROOT_PATH, "resources")
@@ -23,6 +32,12 @@ SETTINGS_PATH = os.path.join(RESOURCES_PATH, "settings.xml")
 PROVIDERS_SCHEMA_PATH = os.path.join(RESOURCES_PATH, "providers.schema.json")
 
 COLOR_REGEX = re.compile(r"^[0-9A-Fa-f]{8}$")
+SEARCH_FIELDS = {
+    "movie": ("tmdb_id", "title", "year"),
+    "show": ("tmdb_id", "title", "year"),
+    "season": ("tmdb_id", "title", "season"),
+    "episode": ("tmdb_id", "title", "season", "episode"),
+}
 
 
 class ValidationError(Exception):
@@ -39,6 +54,39 @@ def get_data_keys(scraper):
             yield key
 
 
+def provider_cost(provider, rows=50, fanout=5):
+    # Estimates the worst case cost of a search from the provider definition, assuming each results page has rows
+    # results and each additional parser with rows yields fanout results per result
+    results_parser = provider["results_parser"]
+    paginated = results_parser.get("next_page_url") is not None
+    pages = results_parser.get("total_pages", 1) if paginated else 1
+    # Static next page urls do not depend on the previous page, so they could be requested at once
+    parallel_pages = paginated and results_parser.get("next_page_url_type", "xpath") == "static"
+
+    requests, results = pages, pages * rows
+    for parser in provider.get("additional_parsers", []):
+        requests += results
+        if parser.get("rows") is not None:
+            results *= fanout
+
+    # Rate limited providers can't do the requests (after the first burst) any faster than their rate
+    limits = provider.get("limits", {})
+    rate = limits.get("rate")
+    min_duration = None if rate is None else max(0, requests - limits.get("burst", max(1, int(rate)))) / rate
+    return dict(name=provider["name"], pages=pages, max_requests=requests, max_results=results,
+                sequential_depth=pages + len(provider.get("additional_parsers", [])),
+                parallel_pages=parallel_pages, min_duration=min_duration)
+
+
+def check_budgets(cost, max_requests=None, max_depth=None, max_duration=None):
+    exceeded = []
+    for key, budget in (("max_requests", max_requests), ("sequential_depth", max_depth),
+                        ("min_duration", max_duration)):
+        if budget is not None and cost[key] is not None and cost[key] > budget:
+            exceeded.append(key)
+    return exceeded
+
+
 def verify(providers_path, schema_path, settings_path):
     if not os.path.exists(providers_path):
         raise ValidationError("providers.json file ({}) does not exist!".format(providers_path))
@@ -87,10 +135,30 @@ def verify(providers_path, schema_path, settings_path):
         else:
             logging.warning("settings.xml setting with id '%s' is not defined", scraper.id)
 
+    return data
+
+
+def verify_costs(args, providers):
+    report = []
+    for provider in providers:
+        cost = provider_cost(provider, rows=args.rows, fanout=args.fanout)
+        cost["over_budget"] = check_budgets(cost, max_requests=args.max_requests, max_depth=args.max_depth,
+                                            max_duration=args.max_duration)
+        report.append(cost)
+        logging.info("Provider %s: up to %d requests, %d sequential requests%s", cost["name"], cost["max_requests"],
+                     cost["sequential_depth"], " (pages can be parallelized)" if cost["parallel_pages"] else "")
+        for key in cost["over_budget"]:
+            logging.warning("Provider %s exceeds the %s budget (%s)", cost["name"], key, round(cost[key], 2))
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+        logging.info("Cost report saved to %s", args.report)
+
 
 def verify_and_print(args):
     try:
-        verify(args.providers_path, args.schema_path, args.settings_path)
+        providers = verify(args.providers_path, args.schema_path, args.settings_path)
     except ValidationError as e:
         logging.error(e)
     except jsonschema.ValidationError as e:
@@ -99,11 +167,34 @@ def verify_and_print(args):
         logging.error("providers.json file must contain valid JSON data")
     else:
         logging.info("The providers.json contents are valid")
+        verify_costs(args, providers)
+
+
+@contextmanager
+def use_archive(args, session, name):
+    archive_dir = args.record or args.replay
+    if not archive_dir:
+        yield
+        return
+
+    archive = Archive(os.path.join(archive_dir, name + ".json.gz"))
+    if args.replay:
+        archive.load()
+        logging.debug("Replaying %d responses from %s", len(archive), archive.path)
+    mount_archive(session, archive, replay=bool(args.replay))
+
+    try:
+        yield
+    finally:
+        if args.record:
+            os.makedirs(args.record, exist_ok=True)
+            archive.save()
+            logging.debug("Recorded %d responses to %s", len(archive), archive.path)
 
 
 # noinspection PyProtectedMember
 def xpath(args):
-    with default_session() as session:
+    with default_session() as session, use_archive(args, session, "xpath"):
         with closing(session.get(args.url)) as response:
             response.raise_for_status()
             content = response.content
@@ -118,11 +209,51 @@ def xpath(args):
         logging.info(parser.get_element(args.xpath, full_element=True))
 
 
-def get_scrapers(args, session=None):
-    return [s for s in Scraper.get_scrapers(args.providers_path, session=session)
+def get_scrapers(args, session=None, cache=None, parse_pool=None, hedger=None, bandwidth=None):
+    return [s for s in Scraper.get_scrapers(args.providers_path, session=session, cache=cache, parse_pool=parse_pool,
+                                            hedger=hedger, bandwidth=bandwidth)
             if not args.provider_id or args.provider_id == s.id]
 
 
+def get_hedger(args):
+    return None if args.hedge is None else Hedger(rate=args.hedge)
+
+
+def get_parse_pool(args):
+    if args.processes is None:
+        return None
+    return ParsePool(args.processes or None, threshold=args.process_threshold * 1024)
+
+
+@contextmanager
+def parse_scrapers(args, bandwidth=None, pool_size=None):
+    with ExitStack() as stack:
+        parse_pool = get_parse_pool(args)
+        if parse_pool is not None:
+            stack.enter_context(parse_pool)
+        hedger = get_hedger(args)
+        if args.record or args.replay:
+            # Each provider gets its own session, so requests are recorded/replayed on a per provider archive
+            scrapers = []
+            with open(args.providers_path) as f:
+                providers = json.load(f)
+            for data in providers:
+                session = stack.enter_context(default_session(pool_size=pool_size))
+                scraper = Scraper.from_data(data, session=session, parse_pool=parse_pool, hedger=hedger,
+                                            bandwidth=bandwidth)
+                if not args.provider_id or args.provider_id == scraper.id:
+                    stack.enter_context(use_archive(args, session, scraper.id))
+                    scrapers.append(scraper)
+        else:
+            session = stack.enter_context(default_session(pool_size=pool_size, http2=args.http2))
+            scrapers = get_scrapers(args, session=session, parse_pool=parse_pool, hedger=hedger, bandwidth=bandwidth)
+        for scraper in scrapers:
+            if scraper.mirrors is not None:
+                scraper.warm_up()
+                logging.info("Provider %s is using mirror %s", scraper.name, scraper.mirrors.current)
+        yield scrapers
+
+
 def print_results(scraper_name, results):
     print("- Found a total of {} results".format(len(results)))
     for result in results:
@@ -164,6 +295,13 @@ def generate_settings(path, enabled_count=-1):
         <setting id="scraper_timeout" type="slider" label="30002" option="int" range="10,1,60" default="30"/>
         <setting id="thread_number" type="slider" label="30004" option="int" range="1,1,50" default="10"/>
         <setting id="enable_bg_dialog" type="bool" label="30003" default="true"/>
+        <setting id="cache_ttl" type="slider" label="30005" option="int" range="0,5,120" default="30"/>
+        <setting id="enable_hedging" type="bool" label="30006" default="false"/>
+        <setting id="enable_index" type="bool" label="30007" default="false"/>
+        <setting id="index_max_age" type="slider" label="30008" option="int" range="1,1,365" default="30"/>
+        <setting id="enable_http2" type="bool" label="30009" default="false"/>
+        <setting id="enable_adaptive_concurrency" type="bool" label="30010" default="true"/>
+        <setting id="memory_ceiling" type="slider" label="30011" option="int" range="0,16,512" default="0"/>
     </category>
     <!-- Providers -->
     <category label="30001">{}
@@ -183,6 +321,18 @@ def generate_settings(path, enabled_count=-1):
     <category label="30040">
         <setting id="require_release_type" type="bool" visible="false"/>{}
     </category>
+    <!-- Service -->
+    <category label="30050">
+        <setting id="enable_service" type="bool" label="30051" default="false"/>
+        <setting id="service_port" type="number" label="30052" default="61235" enable="eq(-1,true)"/>
+    </category>
+    <!-- Prefetch -->
+    <category label="30060">
+        <setting id="prefetch_next_episode" type="bool" label="30061" default="false"/>
+        <setting id="prefetch_next_season" type="bool" label="30062" default="false"/>
+        <setting id="prefetch_threads" type="slider" label="30063" option="int" range="1,1,10" default="2"/>
+        <setting id="prefetch_rate" type="slider" label="30064" option="int" range="0,32,2048" default="256"/>
+    </category>
 </settings>""".format(providers, resolutions, release_types)
 
 
@@ -192,19 +342,125 @@ def generate_settings_and_save(args):
 
 
 def parse_query(args):
-    with default_session() as session:
-        with ScraperRunner(get_scrapers(args, session=session)) as runner:
+    with parse_scrapers(args) as scrapers:
+        with ScraperRunner(scrapers) as runner:
             for scraper, results in runner.parse_query(args.search):
                 print_results(scraper.name, results)
 
 
 def parse_media(args):
-    with default_session() as session:
-        with ScraperRunner(get_scrapers(args, session=session)) as runner:
+    with parse_scrapers(args) as scrapers:
+        with ScraperRunner(scrapers) as runner:
             for scraper, results in runner.parse(args.parser, {f: getattr(args, f) or "" for f in args.fields}):
                 print_results(scraper.name, results)
 
 
+def read_jobs(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            data = json.loads(line)
+            search_type = data.pop("type")
+            if search_type == "query":
+                yield search_type, data["query"]
+            else:
+                yield search_type, {f: data.get(f) or "" for f in SEARCH_FIELDS[search_type]}
+
+
+def batch(args):
+    output = open(args.output, "w") if args.output else None
+    try:
+        # All the threads may run scrapers and additional parsers of the same provider at once
+        with parse_scrapers(args, pool_size=2 * args.thread_number) as scrapers:
+            with ScraperRunner(scrapers, num_threads=args.thread_number) as runner:
+                for (search_type, data), scraper, results in runner.parse_many(read_jobs(args.jobs_path)):
+                    logging.info("%s %s: %d results from %s", search_type, json.dumps(data), len(results), scraper.name)
+                    if output is not None:
+                        output.write(json.dumps(dict(type=search_type, data=data, provider=scraper.name,
+                                                     results=results)) + "\n")
+    finally:
+        if output is not None:
+            output.close()
+
+
+def print_trace_summary(tracer):
+    print("{:<20} {:<10} {:>7} {:>12} {:>12} {:>12}".format(
+        "Provider", "Stage", "Count", "Total (ms)", "Mean (ms)", "Max (ms)"))
+    for provider, stage, count, total, maximum in tracer.summary():
+        print("{:<20} {:<10} {:>7} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            provider[:20], stage, count, total * 1000, total * 1000 / count, maximum * 1000))
+
+
+def print_bandwidth_summary(bandwidth):
+    print("{:<20} {:>8} {:>12} {:>12} {:>7} {:>14}".format(
+        "Provider", "Requests", "Wire", "Decoded", "Ratio", "Download (ms)"))
+    for provider, requests_count, wire, decoded, duration in bandwidth.summary():
+        print("{:<20} {:>8} {:>12} {:>12} {:>7.2f} {:>14.2f}".format(
+            provider[:20], requests_count, sizeof_fmt(wire), sizeof_fmt(decoded), wire / decoded if decoded else 1,
+            duration * 1000))
+
+
+def print_memory_summary(memory):
+    print("{:<20} {:<10} {:>7} {:>12} {:>12} {:>12}".format(
+        "Provider", "Stage", "Count", "Allocated", "Peak", "Retained"))
+    for provider, stage, count, allocated, peak, retained in memory.summary():
+        print("{:<20} {:<10} {:>7} {:>12} {:>12} {:>12}".format(
+            provider[:20], stage, count, sizeof_fmt(allocated), sizeof_fmt(peak), sizeof_fmt(retained)))
+    print("Search peak: {}".format(sizeof_fmt(memory.peak)))
+
+
+def profile(args):
+    memory = None
+    if args.memory or args.memory_ceiling:
+        memory = MemoryAccount(args.memory_ceiling * 1024 * 1024 if args.memory_ceiling else None)
+    bandwidth = Bandwidth()
+    tracer = tracing.enable()
+    try:
+        with parse_scrapers(args, bandwidth=bandwidth) as scrapers:
+            with ScraperRunner(scrapers) as runner:
+                for scraper, results in runner.parse_query(args.search, memory=memory):
+                    logging.info("Provider %s returned %d results", scraper.name, len(results))
+    finally:
+        tracing.disable()
+
+    print_trace_summary(tracer)
+    print()
+    print_bandwidth_summary(bandwidth)
+    if memory is not None:
+        print()
+        print_memory_summary(memory)
+    if args.output:
+        tracer.save(args.output)
+        logging.info("Chrome trace saved to %s", args.output)
+
+
+def serve(args):
+    cache = MemoryCache(args.cache_ttl * 60) if args.cache_ttl > 0 else None
+
+    with ExitStack() as stack:
+        parse_pool = get_parse_pool(args)
+        if parse_pool is not None:
+            stack.enter_context(parse_pool)
+        session = stack.enter_context(default_session(pool_size=args.thread_number, http2=args.http2))
+        scrapers = get_scrapers(args, session=session, cache=cache, parse_pool=parse_pool, hedger=get_hedger(args))
+
+        def search(search_type, data):
+            with ScraperRunner(scrapers, num_threads=args.thread_number) as runner:
+                runner_data = runner.parse_query(data) if search_type == "query" else runner.parse(search_type, data)
+                return [dict(provider=scraper.name, results=results) for scraper, results in runner_data]
+
+        server = SearchServer(args.port, search, host=args.host)
+        logging.info("Search service listening on %s:%s", *server.server_address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
 def convert_json_to_xml(args):
     if re.match("https?://", args.path):
         data = requests.get(args.path).content
@@ -223,6 +479,19 @@ def main():
     parser_verify = subparsers.add_parser("verify", help="Verifies the providers.json file")
     parser_verify.add_argument("-S", "--schema-path", type=str, default=PROVIDERS_SCHEMA_PATH,
                                help="The json schema path (default: {})".format(PROVIDERS_SCHEMA_PATH))
+    parser_verify.add_argument("--rows", type=int, default=50,
+                               help="The assumed number of results per page, for the cost analysis (default: 50)")
+    parser_verify.add_argument("--fanout", type=int, default=5,
+                               help="The assumed number of results per result of additional parsers with rows "
+                                    "(default: 5)")
+    parser_verify.add_argument("--max-requests", type=int, default=250,
+                               help="Flags providers doing more requests per search (default: 250)")
+    parser_verify.add_argument("--max-depth", type=int, default=5,
+                               help="Flags providers doing more sequential requests per search (default: 5)")
+    parser_verify.add_argument("--max-duration", type=float, default=30,
+                               help="Flags providers whose rate limit makes a search take longer, in seconds "
+                                    "(default: 30)")
+    parser_verify.add_argument("-r", "--report", type=str, help="Saves the cost analysis report (JSON) to this path")
     parser_verify.set_defaults(func=verify_and_print)
 
     parser_xpath = subparsers.add_parser("xpath", help="Gets the result of the xpath expression")
@@ -233,6 +502,8 @@ def main():
                                    help="Use the JSON parser")
     parser_xpath_type.add_argument("--html", action="store_const", const=HTMLParser, dest="parser",
                                    help="Use the HTML parser (default)")
+    parser_xpath_type.add_argument("--regex", action="store_const", const=RegexParser, dest="parser",
+                                   help="Use the regex parser (the xpath and rows are patterns)")
     parser_xpath.add_argument("-r", "--rows", type=str, help="Rows xpath (for multiple evaluation)")
     parser_xpath.add_argument("xpath", type=str, help="The xpath expression")
     parser_xpath.add_argument("url", type=str, help="The url where to perform the xpath")
@@ -250,13 +521,38 @@ def main():
     query_parser.add_argument("search", help="The search query")
     query_parser.set_defaults(func=parse_query)
     movie_parser = parsers.add_parser("movie", help="Parses the results for the provided movie")
-    movie_parser.set_defaults(func=parse_media, fields=("tmdb_id", "title", "year"))
+    movie_parser.set_defaults(func=parse_media, fields=SEARCH_FIELDS["movie"])
     show_parser = parsers.add_parser("show", help="Parses the results for the provided show")
-    show_parser.set_defaults(func=parse_media, fields=("tmdb_id", "title", "year"))
+    show_parser.set_defaults(func=parse_media, fields=SEARCH_FIELDS["show"])
     season_parser = parsers.add_parser("season", help="Parses the results for the provided season")
-    season_parser.set_defaults(func=parse_media, fields=("tmdb_id", "title", "season"))
+    season_parser.set_defaults(func=parse_media, fields=SEARCH_FIELDS["season"])
     episode_parser = parsers.add_parser("episode", help="Parses the results for the provided episode")
-    episode_parser.set_defaults(func=parse_media, fields=("tmdb_id", "title", "season", "episode"))
+    episode_parser.set_defaults(func=parse_media, fields=SEARCH_FIELDS["episode"])
+
+    parser_batch = subparsers.add_parser("batch", help="Runs all searches from a jobs file at once")
+    parser_batch.add_argument("jobs_path", help="The jobs file (one JSON search per line)")
+    parser_batch.add_argument("-t", "--thread-number", type=int, default=10,
+                              help="The number of threads shared by all searches (default: 10)")
+    parser_batch.add_argument("-o", "--output", type=str, help="Saves the results (one JSON per line) to this path")
+    parser_batch.set_defaults(func=batch)
+
+    parser_profile = subparsers.add_parser("profile", help="Profiles the search stages of each provider")
+    parser_profile.add_argument("search", help="The search query")
+    parser_profile.add_argument("-o", "--output", type=str, help="Saves the trace (Chrome trace format) to this path")
+    parser_profile.add_argument("--memory", action="store_true", help="Accounts the memory held by each search stage")
+    parser_profile.add_argument("--memory-ceiling", type=int, metavar="MB",
+                                help="Degrades the search once it holds more than MB of memory (implies --memory)")
+    parser_profile.set_defaults(func=profile)
+
+    parser_serve = subparsers.add_parser("serve", help="Runs the search service in the foreground (headless)")
+    parser_serve.add_argument("--host", type=str, default="127.0.0.1", help="The address to bind (default: 127.0.0.1)")
+    parser_serve.add_argument("--port", type=int, default=61236,
+                              help="The port to listen on (default: 61236, not to clash with the addon service)")
+    parser_serve.add_argument("-t", "--thread-number", type=int, default=10,
+                              help="The number of threads used per search (default: 10)")
+    parser_serve.add_argument("-c", "--cache-ttl", type=int, default=30,
+                              help="The results cache duration in minutes, 0 to disable (default: 30)")
+    parser_serve.set_defaults(func=serve)
 
     parser_json2xml = subparsers.add_parser("json2xml", help="Converts a json to XML")
     parser_json2xml.add_argument("path", help="The JSON file path/url")
@@ -279,15 +575,38 @@ def main():
                        help="The addon settings.xml path (default: {})".format(SETTINGS_PATH))
 
     for p in (parser_verify, parser_generate_settings, query_parser,
-              movie_parser, show_parser, season_parser, episode_parser):
+              movie_parser, show_parser, season_parser, episode_parser, parser_profile, parser_batch, parser_serve):
         p.add_argument("-p", "--providers-path", type=str, default=PROVIDERS_PATH,
                        help="The providers.json path (default: {})".format(PROVIDERS_PATH))
 
-    for p in (query_parser, movie_parser, show_parser, season_parser, episode_parser):
+    for p in (query_parser, movie_parser, show_parser, season_parser, episode_parser, parser_profile, parser_batch,
+              parser_serve):
         p.add_argument("-i", "--provider-id", type=str, help="The provider identifier")
 
+    for p in (parser_xpath, query_parser, movie_parser, show_parser, season_parser, episode_parser, parser_profile,
+              parser_batch):
+        p_archive = p.add_mutually_exclusive_group()
+        p_archive.add_argument("--record", type=str, metavar="DIR",
+                               help="Records all requests and responses to an archive (one per provider) in DIR")
+        p_archive.add_argument("--replay", type=str, metavar="DIR",
+                               help="Serves all requests from the archives in DIR, without network access")
+
+    for p in (query_parser, movie_parser, show_parser, season_parser, episode_parser, parser_profile, parser_batch,
+              parser_serve):
+        p.add_argument("--processes", type=int, nargs="?", const=0, metavar="N",
+                       help="Parses big pages in a pool of N processes (default: number of CPUs)")
+        p.add_argument("--process-threshold", type=int, default=128, metavar="KB",
+                       help="The minimum page size to be parsed in the processes pool (default: 128)")
+        p.add_argument("--hedge", type=float, nargs="?", const=0.1, metavar="RATE",
+                       help="Duplicates requests slower than the provider p90 latency, up to RATE of all requests "
+                            "(default: 0.1)")
+        p.add_argument("--http2", action="store_true",
+                       help="Uses HTTP/2 when the providers support it (requires httpx and h2, ignored with "
+                            "--record/--replay)")
+
     for p in (parser_verify, parser_xpath, parser_generate_settings, query_parser,
-              movie_parser, show_parser, season_parser, episode_parser, parser_json2xml):
+              movie_parser, show_parser, season_parser, episode_parser, parser_profile, parser_batch, parser_serve,
+              parser_json2xml):
         p.add_argument("-v", "--verbose", action="store_true", help="Verbose output")
 
     args = parser.parse_args()
@@ -0,0 +1,5 @@
+from flix.kodi import set_logger
+from lib.provider import run_service
+
+set_logger()
+run_service()